@@ -0,0 +1,259 @@
+"""
+JOHN | Revit BIM Manager - Snapshot binário de catálogos
+
+Formato compilado e somente leitura dos catálogos (templates, famílias,
+scripts e normas). Os workers abrem o arquivo com mmap, de modo que N
+processos compartilham uma única cópia física em memória, e cada entrada
+só é decodificada quando acessada.
+
+LAYOUT DO ARQUIVO:
+    cabeçalho   magic (8) | offset do diretório (u64) | nº de catálogos (u32)
+    dados       JSON de cada entrada + chaves do índice
+    tabelas     por catálogo: (offset u64, tamanho u32) de cada entrada
+                e índice ordenado (offset u64, tamanho u16, posição u32)
+    diretório   por catálogo: nome, campo chave, nº de entradas e offsets
+
+USO:
+    python catalogo.py compilar
+    python catalogo.py compilar --fonte catalogos.json --saida catalogo.bin
+"""
+
+from collections.abc import Mapping, Sequence
+from typing import Dict, Iterable, Iterator, Optional
+import argparse
+import io
+import json
+import mmap
+import os
+import struct
+
+MAGIC = b"JOHNCAT1"
+
+_CABECALHO = struct.Struct("<8sQI")
+_DIRETORIO = struct.Struct("<HHIQQ")
+_ENTRADA = struct.Struct("<QI")
+_INDICE = struct.Struct("<QHI")
+
+
+# ============================================
+# LEITURA (MMAP)
+# ============================================
+
+class EntradaCatalogo(Mapping):
+    """Visão de uma entrada do snapshot, decodificada no primeiro acesso"""
+
+    __slots__ = ("_mm", "_inicio", "_fim", "_dados")
+
+    def __init__(self, mm: mmap.mmap, inicio: int, fim: int):
+        self._mm = mm
+        self._inicio = inicio
+        self._fim = fim
+        self._dados = None
+
+    def _carregar(self) -> dict:
+        if self._dados is None:
+            self._dados = json.loads(self._mm[self._inicio:self._fim])
+        return self._dados
+
+    def bruto(self) -> bytes:
+        """JSON da entrada sem decodificar"""
+        return self._mm[self._inicio:self._fim]
+
+    def __getitem__(self, campo: str):
+        return self._carregar()[campo]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._carregar())
+
+    def __len__(self) -> int:
+        return len(self._carregar())
+
+    def __repr__(self) -> str:
+        return f"EntradaCatalogo({self._carregar()!r})"
+
+
+class CatalogoSnapshot(Sequence):
+    """Catálogo somente leitura apoiado no mmap do snapshot"""
+
+    __slots__ = ("_mm", "nome", "chave", "_total", "_entradas", "_indice", "_visoes")
+
+    def __init__(self, mm: mmap.mmap, nome: str, chave: str, total: int, entradas: int, indice: int):
+        self._mm = mm
+        self.nome = nome
+        self.chave = chave
+        self._total = total
+        self._entradas = entradas
+        self._indice = indice
+        # Visões reaproveitadas: cada entrada é decodificada no máximo uma vez por processo
+        self._visoes = [None] * total
+
+    def _entrada(self, posicao: int) -> EntradaCatalogo:
+        visao = self._visoes[posicao]
+        if visao is None:
+            offset, tamanho = _ENTRADA.unpack_from(self._mm, self._entradas + posicao * _ENTRADA.size)
+            visao = self._visoes[posicao] = EntradaCatalogo(self._mm, offset, offset + tamanho)
+        return visao
+
+    def __len__(self) -> int:
+        return self._total
+
+    def __getitem__(self, posicao):
+        if isinstance(posicao, slice):
+            return [self._entrada(i) for i in range(*posicao.indices(self._total))]
+        if posicao < 0:
+            posicao += self._total
+        if not 0 <= posicao < self._total:
+            raise IndexError("posição fora do catálogo")
+        return self._entrada(posicao)
+
+    def __iter__(self) -> Iterator[EntradaCatalogo]:
+        for posicao in range(self._total):
+            yield self._entrada(posicao)
+
+    def buscar(self, valor: str) -> Optional[EntradaCatalogo]:
+        """Busca binária pelo campo chave sem decodificar outras entradas"""
+        alvo = str(valor).encode("utf-8")
+        inicio, fim = 0, self._total
+        while inicio < fim:
+            meio = (inicio + fim) // 2
+            offset, tamanho, _ = _INDICE.unpack_from(self._mm, self._indice + meio * _INDICE.size)
+            if self._mm[offset:offset + tamanho] < alvo:
+                inicio = meio + 1
+            else:
+                fim = meio
+
+        if inicio == self._total:
+            return None
+        offset, tamanho, posicao = _INDICE.unpack_from(self._mm, self._indice + inicio * _INDICE.size)
+        return self._entrada(posicao) if self._mm[offset:offset + tamanho] == alvo else None
+
+    def __repr__(self) -> str:
+        return f"CatalogoSnapshot({self.nome!r}, entradas={self._total})"
+
+
+class Snapshot(Mapping):
+    """Arquivo de snapshot aberto via mmap; lê apenas o diretório na abertura"""
+
+    __slots__ = ("caminho", "_mm", "_catalogos")
+
+    def __init__(self, caminho: str):
+        self.caminho = caminho
+        with open(caminho, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, diretorio, total = _CABECALHO.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"Snapshot de catálogo inválido: {caminho}")
+
+        self._catalogos: Dict[str, CatalogoSnapshot] = {}
+        posicao = diretorio
+        for _ in range(total):
+            tam_nome, tam_chave, entradas, tabela, indice = _DIRETORIO.unpack_from(self._mm, posicao)
+            posicao += _DIRETORIO.size
+            nome = self._mm[posicao:posicao + tam_nome].decode("utf-8")
+            posicao += tam_nome
+            chave = self._mm[posicao:posicao + tam_chave].decode("utf-8")
+            posicao += tam_chave
+            self._catalogos[nome] = CatalogoSnapshot(self._mm, nome, chave, entradas, tabela, indice)
+
+    def fechar(self):
+        """Libera o mapeamento (as entradas deste snapshot deixam de ser legíveis)"""
+        self._mm.close()
+
+    def __getitem__(self, nome: str) -> CatalogoSnapshot:
+        return self._catalogos[nome]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._catalogos)
+
+    def __len__(self) -> int:
+        return len(self._catalogos)
+
+
+def json_bruto(entradas: Iterable[EntradaCatalogo]) -> bytes:
+    """Array JSON das entradas a partir dos bytes gravados, sem decodificar"""
+    return b"[" + b",".join(entrada.bruto() for entrada in entradas) + b"]"
+
+
+def abrir_snapshot(caminho: str) -> Snapshot:
+    """Abre snapshot de catálogos compartilhado via mmap"""
+    return Snapshot(caminho)
+
+
+# ============================================
+# COMPILAÇÃO
+# ============================================
+
+def compilar_snapshot(catalogos: Dict[str, list], chaves: Dict[str, str], destino: str) -> int:
+    """Compila catálogos (listas de dicts) para o formato binário"""
+    saida = io.BytesIO()
+    saida.write(b"\0" * _CABECALHO.size)
+    diretorio = []
+
+    for nome, entradas in catalogos.items():
+        chave = chaves.get(nome, "id")
+        tabela = []
+        indice = []
+
+        for posicao, entrada in enumerate(entradas):
+            dados = json.dumps(entrada, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            tabela.append((saida.tell(), len(dados)))
+            saida.write(dados)
+
+            valor = str(entrada.get(chave, "")).encode("utf-8")
+            indice.append((valor, saida.tell(), posicao))
+            saida.write(valor)
+
+        offset_tabela = saida.tell()
+        for offset, tamanho in tabela:
+            saida.write(_ENTRADA.pack(offset, tamanho))
+
+        offset_indice = saida.tell()
+        for valor, offset, posicao in sorted(indice):
+            saida.write(_INDICE.pack(offset, len(valor), posicao))
+
+        diretorio.append((nome, chave, len(entradas), offset_tabela, offset_indice))
+
+    offset_diretorio = saida.tell()
+    for nome, chave, total, tabela, indice in diretorio:
+        nome_bytes, chave_bytes = nome.encode("utf-8"), chave.encode("utf-8")
+        saida.write(_DIRETORIO.pack(len(nome_bytes), len(chave_bytes), total, tabela, indice))
+        saida.write(nome_bytes + chave_bytes)
+
+    saida.seek(0)
+    saida.write(_CABECALHO.pack(MAGIC, offset_diretorio, len(diretorio)))
+
+    # Substituição atômica: workers com o arquivo antigo mapeado não são afetados
+    temporario = f"{destino}.tmp"
+    with open(temporario, "wb") as f:
+        f.write(saida.getvalue())
+    os.replace(temporario, destino)
+    return len(saida.getvalue())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Snapshot binário dos catálogos JOHN")
+    comandos = parser.add_subparsers(dest="comando", required=True)
+
+    compilar = comandos.add_parser("compilar", help="Compila os catálogos para o snapshot")
+    compilar.add_argument("--fonte", help="JSON com os catálogos ({\"templates\": [...], ...})")
+    compilar.add_argument("--saida", help="Arquivo de saída (padrão: JOHN_CATALOGO ou catalogo.bin)")
+
+    args = parser.parse_args(argv)
+
+    # Import tardio: o servidor importa este módulo para ler o snapshot
+    import main as servidor
+
+    catalogos = dict(servidor.CATALOGOS_PADRAO)
+    if args.fonte:
+        with open(args.fonte, encoding="utf-8") as f:
+            catalogos.update(json.load(f))
+
+    destino = args.saida or servidor.CATALOGO_ARQUIVO
+    tamanho = compilar_snapshot(catalogos, servidor.CATALOGO_CHAVES, destino)
+    total = sum(len(entradas) for entradas in catalogos.values())
+    print(f"[OK] Snapshot gerado: {destino} ({total} entradas, {tamanho / 1024:.1f} KB)")
+
+
+if __name__ == "__main__":
+    main()
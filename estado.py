@@ -0,0 +1,173 @@
+"""
+JOHN | Revit BIM Manager - Estado compartilhado entre workers
+
+Requisições (/status, /requisicoes), respostas guardadas por Idempotency-Key
+e falhas de webhook ficam num arquivo SQLite em modo WAL, aberto por todos os
+workers do lançador. O estado sobrevive à reciclagem de workers e à recarga
+por SIGHUP, e qualquer worker responde sobre requisições criadas em outro.
+
+Cada processo (e thread) abre a própria conexão no primeiro uso: o mestre do
+lançador importa o app antes do fork e nenhuma conexão é herdada pelos workers.
+As operações são curtas (uma instrução cada) e rodam no próprio handler.
+"""
+
+from typing import List, Optional, Tuple
+import json
+import os
+import sqlite3
+import threading
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS requisicoes (
+    id TEXT PRIMARY KEY,
+    tipo TEXT NOT NULL,
+    registro TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS idempotencia (
+    chave TEXT NOT NULL,
+    caminho TEXT NOT NULL,
+    impressao BLOB NOT NULL,
+    expira_em REAL NOT NULL,
+    status INTEGER,
+    headers TEXT,
+    corpo BLOB,
+    PRIMARY KEY (chave, caminho)
+);
+CREATE INDEX IF NOT EXISTS idempotencia_expira_em ON idempotencia (expira_em);
+
+CREATE TABLE IF NOT EXISTS webhook_falhas (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    falha TEXT NOT NULL
+);
+"""
+
+# Mesmo formato do JSONResponse do FastAPI: o registro é devolvido sem reserializar
+def _json(valor) -> str:
+    return json.dumps(valor, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class EstadoCompartilhado:
+    """Estado dos handlers num arquivo SQLite compartilhado pelos workers"""
+
+    def __init__(self, caminho: str, timeout: float = 5.0):
+        self.caminho = caminho
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _conexao(self) -> sqlite3.Connection:
+        # O pid distingue a conexão herdada por fork (threading.local é copiado)
+        conexao = getattr(self._local, "conexao", None)
+        if conexao is None or self._local.pid != os.getpid():
+            conexao = sqlite3.connect(self.caminho, timeout=self.timeout, isolation_level=None)
+            conexao.execute("PRAGMA journal_mode=WAL")
+            conexao.execute("PRAGMA synchronous=NORMAL")
+            conexao.executescript(ESQUEMA)
+            self._local.conexao, self._local.pid = conexao, os.getpid()
+        return conexao
+
+    def fechar(self):
+        conexao = getattr(self._local, "conexao", None)
+        if conexao is not None and self._local.pid == os.getpid():
+            conexao.close()
+        self._local.conexao = None
+
+    # --- Requisições ---
+    # Os ids são ULIDs: a ordem da chave primária é a ordem de criação
+
+    def salvar_requisicao(self, id_req: str, tipo: str, registro: dict):
+        self._conexao().execute(
+            "INSERT OR REPLACE INTO requisicoes (id, tipo, registro) VALUES (?, ?, ?)",
+            (id_req, tipo, _json(registro))
+        )
+
+    def obter_requisicao(self, id_req: str) -> Optional[str]:
+        """JSON do registro, ou None"""
+        linha = self._conexao().execute(
+            "SELECT registro FROM requisicoes WHERE id = ?", (id_req,)
+        ).fetchone()
+        return linha[0] if linha else None
+
+    def consultar_requisicoes(self, id_min: str, id_max: str, tipo: Optional[str], limite: int) -> List[str]:
+        """JSON dos registros com id no intervalo, em ordem de criação"""
+        sql = "SELECT registro FROM requisicoes WHERE id BETWEEN ? AND ?"
+        parametros: list = [id_min, id_max]
+        if tipo:
+            sql += " AND tipo = ?"
+            parametros.append(tipo)
+        parametros.append(limite)
+        linhas = self._conexao().execute(sql + " ORDER BY id LIMIT ?", parametros)
+        return [registro for registro, in linhas]
+
+    def expirar_requisicoes(self, id_limite: str) -> List[Tuple[str, str]]:
+        """Remove as requisições anteriores a id_limite; devolve (id, tipo) removidos"""
+        return self._conexao().execute(
+            "DELETE FROM requisicoes WHERE id < ? RETURNING id, tipo", (id_limite,)
+        ).fetchall()
+
+    # --- Idempotência ---
+
+    def reservar_idempotencia(self, chave: str, caminho: str, impressao: bytes,
+                              agora: float, reserva_ate: float) -> Optional[tuple]:
+        """
+        Reserva a chave para a primeira execução (devolve None) ou devolve a
+        entrada existente: (impressao, status, headers, corpo), com status None
+        enquanto outro processo executa. Entradas vencidas são reaproveitadas.
+        """
+        conexao = self._conexao()
+        reservada = conexao.execute(
+            "INSERT INTO idempotencia (chave, caminho, impressao, expira_em) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (chave, caminho) DO UPDATE SET impressao = excluded.impressao,"
+            " expira_em = excluded.expira_em, status = NULL, headers = NULL, corpo = NULL"
+            " WHERE idempotencia.expira_em <= ?",
+            (chave, caminho, impressao, reserva_ate, agora)
+        ).rowcount
+        if reservada:
+            return None
+        linha = conexao.execute(
+            "SELECT impressao, status, headers, corpo FROM idempotencia WHERE chave = ? AND caminho = ?",
+            (chave, caminho)
+        ).fetchone()
+        if linha is None:
+            # Liberada entre as duas instruções: a próxima tentativa reserva
+            return (impressao, None, None, None)
+        impressao_salva, status, headers, corpo = linha
+        if headers is not None:
+            headers = [(nome.encode("latin-1"), valor.encode("latin-1")) for nome, valor in json.loads(headers)]
+        return impressao_salva, status, headers, corpo
+
+    def guardar_idempotencia(self, chave: str, caminho: str, expira_em: float, status: int,
+                             headers: List[tuple], corpo: bytes, agora: float, max_entradas: int):
+        conexao = self._conexao()
+        conexao.execute(
+            "UPDATE idempotencia SET expira_em = ?, status = ?, headers = ?, corpo = ?"
+            " WHERE chave = ? AND caminho = ?",
+            (expira_em, status, json.dumps([(n.decode("latin-1"), v.decode("latin-1")) for n, v in headers]),
+             corpo, chave, caminho)
+        )
+        # Vencidas e, acima do limite, as mais antigas (rowid cresce a cada reserva)
+        conexao.execute("DELETE FROM idempotencia WHERE expira_em <= ?", (agora,))
+        conexao.execute(
+            "DELETE FROM idempotencia WHERE rowid <= (SELECT max(rowid) FROM idempotencia) - ?",
+            (max_entradas,)
+        )
+
+    def liberar_idempotencia(self, chave: str, caminho: str):
+        """Desfaz a reserva de uma execução que não teve a resposta guardada"""
+        self._conexao().execute(
+            "DELETE FROM idempotencia WHERE chave = ? AND caminho = ? AND status IS NULL",
+            (chave, caminho)
+        )
+
+    # --- Falhas de webhook (dead letter) ---
+
+    def registrar_falha_webhook(self, falha: dict, maximo: int):
+        conexao = self._conexao()
+        id_falha = conexao.execute(
+            "INSERT INTO webhook_falhas (falha) VALUES (?)", (_json(falha),)
+        ).lastrowid
+        conexao.execute("DELETE FROM webhook_falhas WHERE id <= ?", (id_falha - maximo,))
+
+    def falhas_webhook(self) -> List[dict]:
+        linhas = self._conexao().execute("SELECT falha FROM webhook_falhas ORDER BY id")
+        return [json.loads(falha) for falha, in linhas]
@@ -0,0 +1,301 @@
+"""
+JOHN | Revit BIM Manager - Lançador de produção
+
+Servidor multiprocesso: o processo mestre carrega o app e os catálogos uma
+única vez e cria os workers por fork, que compartilham essa memória por
+copy-on-write.
+
+O socket de escuta é do mestre e usa SO_REUSEPORT: workers reciclados não
+derrubam conexões pendentes, e um segundo lançador pode abrir a mesma porta.
+Com --socket-por-worker cada worker tem o próprio socket e o kernel
+distribui as conexões entre eles (conexões na fila de um worker que sai
+são perdidas).
+
+USO:
+    python lancador.py
+    python lancador.py --workers 8 --porta 8000 --max-requisicoes 10000 --max-rss-mb 512
+
+SINAIS (mestre):
+    SIGHUP    recarrega o snapshot de catálogos e substitui os workers um a um
+    SIGTERM   encerramento gracioso
+    SIGINT    encerramento gracioso
+
+Para publicar código novo sem indisponibilidade, inicie um novo lançador
+na mesma porta e envie SIGTERM ao anterior.
+
+No Windows (sem fork) executa um único processo, como `python main.py`.
+
+Requisições, respostas de Idempotency-Key e falhas de webhook ficam no SQLite
+compartilhado (JOHN_ESTADO_DB, ver estado.py): sobrevivem à reciclagem e à
+recarga, e qualquer worker as encontra.
+"""
+
+from typing import Dict, Optional
+import argparse
+import gc
+import os
+import random
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+
+import uvicorn
+
+# Segundos para um worker ficar pronto / encerrar antes de ser forçado
+TIMEOUT_INICIO = 30.0
+TIMEOUT_ENCERRAMENTO = 30.0
+
+INTERVALO_VERIFICACAO_RSS = 5.0
+
+
+def log(mensagem: str):
+    print(f"[lancador {os.getpid()}] {mensagem}", flush=True)
+
+
+def criar_socket(host: str, porta: int, reuseport: bool) -> socket.socket:
+    """Cria o socket de escuta (com SO_REUSEPORT quando solicitado)"""
+    familia = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(familia, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, porta))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def rss_mb() -> float:
+    """Memória residente atual do processo, em MB"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1048576
+    except OSError:
+        # Sem /proc: pico de RSS (KB no Linux, bytes no macOS)
+        import resource
+        pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return pico / (1048576 if sys.platform == "darwin" else 1024)
+
+
+class Lancador:
+    """Processo mestre: cria, vigia, recicla e substitui os workers"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.host = args.host
+        self.porta = args.porta
+        self.total_workers = args.workers
+        self.max_requisicoes = args.max_requisicoes
+        self.max_rss_mb = args.max_rss_mb
+        self.log_level = args.log_level
+        self.forwarded_allow_ips = args.forwarded_allow_ips
+        self.reuseport = args.reuseport and hasattr(socket, "SO_REUSEPORT")
+        self.socket_por_worker = args.socket_por_worker and self.reuseport
+        self.app = None
+        self.sock: Optional[socket.socket] = None
+        # pid -> instante de início
+        self.workers: Dict[int, float] = {}
+        self.parar = False
+        self.recarregar = False
+
+    def executar(self):
+        # Pré-carga: app, catálogos (mmap) e regras ficam no mestre antes do fork
+        import main
+        self.app = main.app
+
+        # Objetos pré-carregados saem do rastreamento do GC para não serem
+        # tocados (e copiados) pelas coletas nos workers
+        gc.collect()
+        gc.freeze()
+
+        # Socket por worker: o mestre não escuta (conexões enviadas pelo kernel a
+        # um socket sem accept ficariam pendentes)
+        if not self.socket_por_worker:
+            self.sock = criar_socket(self.host, self.porta, self.reuseport)
+
+        signal.signal(signal.SIGHUP, self._sinal_recarregar)
+        signal.signal(signal.SIGTERM, self._sinal_parar)
+        signal.signal(signal.SIGINT, self._sinal_parar)
+
+        log(f"Iniciando {self.total_workers} workers em http://{self.host}:{self.porta}"
+            f" (SO_REUSEPORT: {'sim' if self.reuseport else 'não'},"
+            f" socket por worker: {'sim' if self.socket_por_worker else 'não'})")
+        for _ in range(self.total_workers):
+            self._iniciar_worker()
+
+        while not self.parar:
+            if self.recarregar:
+                self.recarregar = False
+                self._recarga_gradual()
+            self._recolher()
+            time.sleep(0.5)
+
+        self._encerrar_todos()
+        log("Encerrado")
+
+    def _sinal_recarregar(self, *_):
+        self.recarregar = True
+
+    def _sinal_parar(self, *_):
+        self.parar = True
+
+    # --- Workers ---
+
+    def _iniciar_worker(self, aguardar_pronto: bool = False) -> int:
+        leitura, escrita = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+            os.close(leitura)
+            codigo = 0
+            try:
+                self._executar_worker(escrita)
+            except BaseException as erro:
+                print(f"[ERRO] Worker {os.getpid()}: {erro!r}", file=sys.stderr, flush=True)
+                codigo = 1
+            finally:
+                os._exit(codigo)
+
+        os.close(escrita)
+        self.workers[pid] = time.monotonic()
+        if aguardar_pronto:
+            pronto, _, _ = select.select([leitura], [], [], TIMEOUT_INICIO)
+            if not pronto:
+                log(f"Worker {pid} não ficou pronto em {TIMEOUT_INICIO:.0f}s")
+        os.close(leitura)
+        return pid
+
+    def _executar_worker(self, aviso_pronto: int):
+        for sinal in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(sinal, signal.SIG_DFL)
+
+        sock = criar_socket(self.host, self.porta, True) if self.socket_por_worker else self.sock
+
+        # Limite com variação aleatória para os workers não reciclarem juntos
+        limite = None
+        if self.max_requisicoes:
+            limite = self.max_requisicoes + random.randint(0, self.max_requisicoes // 10)
+
+        servidor = uvicorn.Server(uvicorn.Config(
+            self.app,
+            log_level=self.log_level,
+            limit_max_requests=limite,
+            proxy_headers=True,
+            forwarded_allow_ips=self.forwarded_allow_ips,
+            timeout_graceful_shutdown=TIMEOUT_ENCERRAMENTO
+        ))
+        threading.Thread(target=self._vigiar_worker, args=(servidor, aviso_pronto), daemon=True).start()
+        servidor.run(sockets=[sock])
+
+    def _vigiar_worker(self, servidor: uvicorn.Server, aviso_pronto: int):
+        """Avisa o mestre quando o worker está pronto e recicla por RSS"""
+        while not servidor.started and not servidor.should_exit:
+            time.sleep(0.05)
+        try:
+            os.write(aviso_pronto, b"1")
+        except OSError:
+            pass
+        os.close(aviso_pronto)
+
+        while self.max_rss_mb and not servidor.should_exit:
+            time.sleep(INTERVALO_VERIFICACAO_RSS)
+            memoria = rss_mb()
+            if memoria > self.max_rss_mb:
+                log(f"RSS {memoria:.0f} MB acima do limite ({self.max_rss_mb} MB), reciclando worker")
+                servidor.should_exit = True
+
+    def _recolher(self):
+        """Recolhe workers encerrados e repõe os que saíram sem ser solicitado"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+            iniciado = self.workers.pop(pid, None)
+            if iniciado is None or self.parar:
+                continue
+
+            log(f"Worker {pid} saiu (código {os.waitstatus_to_exitcode(status)}), iniciando substituto")
+            # Evita laço de reinício quando o worker falha logo ao subir
+            if time.monotonic() - iniciado < 1.0:
+                time.sleep(1.0)
+            self._iniciar_worker()
+
+    def _aguardar_saida(self, pid: int, timeout: float):
+        limite = time.monotonic() + timeout
+        while time.monotonic() < limite:
+            try:
+                encerrado, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if encerrado:
+                return
+            time.sleep(0.1)
+        log(f"Worker {pid} não encerrou em {timeout:.0f}s, forçando")
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+    def _recarga_gradual(self):
+        """Substitui os workers um a um: o novo fica pronto antes do antigo sair"""
+        import main
+        main.carregar_snapshot_catalogos()
+        gc.collect()
+        gc.freeze()
+
+        log("Recarga gradual iniciada")
+        for pid in list(self.workers):
+            if self.parar:
+                return
+            self._iniciar_worker(aguardar_pronto=True)
+            if self.workers.pop(pid, None) is not None:
+                os.kill(pid, signal.SIGTERM)
+                self._aguardar_saida(pid, TIMEOUT_ENCERRAMENTO)
+        log("Recarga gradual concluída")
+
+    def _encerrar_todos(self):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(self.workers):
+            self._aguardar_saida(pid, TIMEOUT_ENCERRAMENTO)
+        self.workers.clear()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Lançador de produção do JOHN API Server")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--porta", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("JOHN_WORKERS", os.cpu_count() or 1)),
+                        help="Número de workers (padrão: JOHN_WORKERS ou nº de CPUs)")
+    parser.add_argument("--max-requisicoes", type=int, default=int(os.getenv("JOHN_MAX_REQUISICOES", "0")),
+                        help="Recicla o worker após N requisições (0 = sem limite)")
+    parser.add_argument("--max-rss-mb", type=int, default=int(os.getenv("JOHN_MAX_RSS_MB", "0")),
+                        help="Recicla o worker acima deste RSS em MB (0 = sem limite)")
+    parser.add_argument("--sem-reuseport", dest="reuseport", action="store_false",
+                        help="Não usa SO_REUSEPORT no socket de escuta")
+    parser.add_argument("--socket-por-worker", action="store_true",
+                        help="Cada worker abre o próprio socket (SO_REUSEPORT), balanceado pelo kernel")
+    parser.add_argument("--log-level", default=os.getenv("JOHN_LOG_LEVEL", "info"))
+    parser.add_argument("--forwarded-allow-ips", default=os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+                        help="Proxies cujo X-Forwarded-For identifica o cliente ('*' quando o proxy"
+                             " da plataforma é o único acesso ao servidor)")
+    args = parser.parse_args(argv)
+
+    if not hasattr(os, "fork"):
+        import main as servidor
+        uvicorn.run(servidor.app, host=args.host, port=args.porta, log_level=args.log_level,
+                    forwarded_allow_ips=args.forwarded_allow_ips)
+        return
+
+    Lancador(args).executar()
+
+
+if __name__ == "__main__":
+    main()
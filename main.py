@@ -20,11 +20,46 @@ NGROK:
 
 from fastapi import FastAPI, HTTPException, Query, Path
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import FileResponse, Response
+from starlette.datastructures import MutableHeaders
+from pydantic import BaseModel, Field, field_validator
+import httpcore
+import httpx
 from typing import Optional, List, Dict, Any
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-import uuid
+from collections import OrderedDict, deque
+from functools import lru_cache
+from string import Template
+from urllib.parse import urlsplit
+from xml.sax.saxutils import escape
+from catalogo import CatalogoSnapshot, abrir_snapshot, json_bruto
+from estado import EstadoCompartilhado
+import asyncio
+import base64
+import gzip
+import hashlib
+import io
+import ipaddress
+import os
+import random
+import shutil
+import socket
+import textwrap
+import threading
+import time
+import unicodedata
 import json
+import mmap
+import multiprocessing
+import re
+import zipfile
+import zlib
+
+try:
+    import brotli
+except ImportError:  # brotli é opcional: sem ele, apenas gzip
+    brotli = None
 
 # ============================================
 # INICIALIZAÇÃO DO APP
@@ -50,11 +85,18 @@ app.add_middleware(
 )
 
 # ============================================
-# BANCO DE DADOS EM MEMÓRIA (SIMULADO)
+# BANCO DE DADOS (SIMULADO)
 # ============================================
 
-# Armazena requisições
-requisicoes_db: Dict[str, Dict] = {}
+# Requisições, respostas de Idempotency-Key e falhas de webhook: SQLite
+# compartilhado por todos os workers (sobrevive a reciclagem e recarga)
+ESTADO_ARQUIVO = os.getenv(
+    "JOHN_ESTADO_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "estado.db")
+)
+estado_db = EstadoCompartilhado(ESTADO_ARQUIVO)
+
+REQUISICOES_TTL_HORAS = float(os.getenv("JOHN_REQUISICOES_TTL_HORAS", "24"))
 
 # Templates pré-definidos
 templates_db = [
@@ -179,13 +221,66 @@ normas_db = [
     }
 ]
 
+# Catálogos embutidos e campo usado como chave de busca em cada um
+CATALOGOS_PADRAO = {
+    "templates": templates_db,
+    "familias": familias_db,
+    "scripts": scripts_db,
+    "normas": normas_db
+}
+CATALOGO_CHAVES = {"templates": "id", "familias": "id", "scripts": "id", "normas": "codigo"}
+
+# Snapshot binário compartilhado entre workers via mmap (gerado por: python catalogo.py compilar)
+CATALOGO_ARQUIVO = os.getenv(
+    "JOHN_CATALOGO",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalogo.bin")
+)
+
+_snapshot_catalogos = None
+
+def carregar_snapshot_catalogos():
+    """(Re)abre o snapshot dos catálogos, se existir; senão mantém os embutidos"""
+    global templates_db, familias_db, scripts_db, normas_db, _snapshot_catalogos
+    if not os.path.exists(CATALOGO_ARQUIVO):
+        return
+    snapshot = abrir_snapshot(CATALOGO_ARQUIVO)
+    templates_db = snapshot.get("templates", CATALOGOS_PADRAO["templates"])
+    familias_db = snapshot.get("familias", CATALOGOS_PADRAO["familias"])
+    scripts_db = snapshot.get("scripts", CATALOGOS_PADRAO["scripts"])
+    normas_db = snapshot.get("normas", CATALOGOS_PADRAO["normas"])
+
+    # Na recarga (SIGHUP no mestre) o mapeamento anterior é liberado; workers
+    # já criados têm a própria cópia do mapeamento e não são afetados
+    anterior, _snapshot_catalogos = _snapshot_catalogos, snapshot
+    if anterior is not None:
+        anterior.fechar()
+
+carregar_snapshot_catalogos()
+
 
 # ============================================
 # MODELOS PYDANTIC (REQUEST/RESPONSE)
 # ============================================
 
+# --- Webhooks ---
+class WebhookRequest(BaseModel):
+    """Base dos POSTs que geram requisição: aceita URL de notificação"""
+    callback_url: Optional[str] = Field(None, description="URL notificada com o registro final da requisição")
+
+    @field_validator("callback_url")
+    @classmethod
+    def validar_callback_url(cls, valor: Optional[str]) -> Optional[str]:
+        if valor:
+            partes = urlsplit(valor)
+            if partes.scheme not in ("http", "https") or not partes.hostname:
+                raise ValueError("callback_url deve ser uma URL http(s)")
+            erro = verificar_host_webhook(partes.hostname)
+            if erro:
+                raise ValueError(erro)
+        return valor
+
 # --- Templates ---
-class TemplateRequest(BaseModel):
+class TemplateRequest(WebhookRequest):
     tipo_projeto: str = Field(..., description="Tipo do projeto")
     disciplina: Optional[str] = "arquitetura"
     normas: Optional[List[str]] = []
@@ -198,7 +293,7 @@ class TemplateResponse(BaseModel):
     mensagem: str
 
 # --- Famílias ---
-class FamiliaRequest(BaseModel):
+class FamiliaRequest(WebhookRequest):
     nome: str
     categoria: str
     lod: Optional[int] = 300
@@ -212,7 +307,7 @@ class FamiliaResponse(BaseModel):
     mensagem: str
 
 # --- Dynamo ---
-class DynamoScriptRequest(BaseModel):
+class DynamoScriptRequest(WebhookRequest):
     descricao: str
     categoria: Optional[str] = "automacao"
     usar_python: Optional[bool] = False
@@ -223,7 +318,7 @@ class PythonNodeRequest(BaseModel):
     usar_revit_api: Optional[bool] = True
 
 # --- Auditoria ---
-class AuditoriaRequest(BaseModel):
+class AuditoriaRequest(WebhookRequest):
     arquivo_url: str
     nivel_auditoria: Optional[str] = "padrao"
 
@@ -233,35 +328,91 @@ class ChecklistRequest(BaseModel):
     disciplinas: Optional[List[str]] = []
 
 # --- Quantitativos ---
-class QuantitativosRequest(BaseModel):
+class QuantitativosRequest(WebhookRequest):
     arquivo_url: str
     categorias: Optional[List[str]] = []
     formato_saida: Optional[str] = "json"
 
 # --- IFC ---
-class IFCValidacaoRequest(BaseModel):
+class IFCValidacaoRequest(WebhookRequest):
     arquivo_url: str
     mvd: Optional[str] = "coordination_view"
 
 # --- Relatórios ---
-class BEPRequest(BaseModel):
+class BEPRequest(WebhookRequest):
     nome_projeto: str
     tipo_projeto: str
     cliente: Optional[str] = ""
     disciplinas: Optional[List[str]] = []
+    formato: Optional[str] = Field("pdf", description="Formato do documento (pdf, docx)")
 
 
 # ============================================
 # FUNÇÕES AUXILIARES
 # ============================================
 
+# Alfabeto Crockford Base32 (ordem ASCII = ordem numérica)
+_ULID_ALFABETO = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+_ULID_ALEATORIO_MAX = (1 << 80) - 1
+_ultimo_ulid = [0, 0]
+
+def _codificar_base32(valor: int, tamanho: int) -> str:
+    """Codifica inteiro em Base32 Crockford com tamanho fixo"""
+    caracteres = []
+    for _ in range(tamanho):
+        caracteres.append(_ULID_ALFABETO[valor & 31])
+        valor >>= 5
+    return "".join(reversed(caracteres))
+
 def gerar_id_requisicao() -> str:
-    """Gera ID único para requisição"""
-    return f"req-{uuid.uuid4().hex[:8]}"
+    """Gera ID único ordenável no tempo (ULID com prefixo req-)"""
+    agora = int(time.time() * 1000)
+    ultimo, aleatorio = _ultimo_ulid
+
+    if agora <= ultimo:
+        # Mesmo milissegundo (ou relógio recuou): incrementa para manter a ordem
+        agora, aleatorio = ultimo, aleatorio + 1
+        if aleatorio > _ULID_ALEATORIO_MAX:
+            agora, aleatorio = agora + 1, 0
+    else:
+        aleatorio = int.from_bytes(os.urandom(10), "big")
 
-def salvar_requisicao(id_req: str, tipo: str, dados: dict):
+    _ultimo_ulid[:] = [agora, aleatorio]
+    return f"req-{_codificar_base32(agora, 10)}{_codificar_base32(aleatorio, 16)}"
+
+def _limite_id(timestamp_ms: int, final: bool) -> str:
+    """Menor (ou maior) ID possível para um timestamp"""
+    return f"req-{_codificar_base32(timestamp_ms, 10)}{('Z' if final else '0') * 16}"
+
+def buscar_no_catalogo(catalogo, campo: str, valor: str) -> Optional[dict]:
+    """Busca entrada por campo (usa o índice do snapshot quando disponível)"""
+    if getattr(catalogo, "chave", None) == campo:
+        entrada = catalogo.buscar(valor)
+    else:
+        entrada = next((e for e in catalogo if e[campo] == valor), None)
+    return dict(entrada) if entrada is not None else None
+
+def filtrar_catalogo(catalogo, **filtros):
+    """Lista entradas do catálogo que atendem aos filtros informados"""
+    filtros = {campo: valor for campo, valor in filtros.items() if valor}
+    entradas = [
+        e for e in catalogo
+        if all(e[campo] == valor for campo, valor in filtros.items())
+    ] if filtros else catalogo
+
+    # Snapshot: responde com o JSON já gravado, sem decodificar nem reserializar
+    if isinstance(catalogo, CatalogoSnapshot):
+        return Response(json_bruto(entradas), media_type="application/json")
+    return [dict(e) for e in entradas]
+
+def normalizar_chave(texto: str) -> str:
+    """Normaliza texto para uso como chave (minúsculo, sem acentos)"""
+    sem_acento = unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode("ascii")
+    return sem_acento.strip().lower().replace(" ", "_")
+
+def salvar_requisicao(id_req: str, tipo: str, dados: dict, callback_url: Optional[str] = None):
     """Salva requisição no banco"""
-    requisicoes_db[id_req] = {
+    registro = {
         "id_requisicao": id_req,
         "tipo": tipo,
         "status": "concluido",
@@ -269,6 +420,30 @@ def salvar_requisicao(id_req: str, tipo: str, dados: dict):
         "criado_em": datetime.now().isoformat(),
         "resultado": dados
     }
+    estado_db.salvar_requisicao(id_req, tipo, registro)
+
+    expirar_requisicoes()
+
+    if callback_url:
+        fila_webhooks.agendar(callback_url, registro)
+
+def expirar_requisicoes(agora_ms: Optional[int] = None) -> int:
+    """Remove as requisições que já passaram do TTL"""
+    agora_ms = agora_ms if agora_ms is not None else int(time.time() * 1000)
+    limite = agora_ms - int(REQUISICOES_TTL_HORAS * 3600 * 1000)
+    removidas = estado_db.expirar_requisicoes(_limite_id(limite, False))
+
+    # Arquivos gerados expiram junto com a requisição
+    for id_req, tipo in removidas:
+        if tipo == "bep":
+            shutil.rmtree(os.path.join(ARQUIVOS_DIR, id_req), ignore_errors=True)
+
+    return len(removidas)
+
+def consultar_requisicoes(desde_ms: int, ate_ms: int, tipo: Optional[str], limite: int) -> bytes:
+    """Varredura por intervalo de tempo pela chave (ULID); devolve o JSON da lista"""
+    registros = estado_db.consultar_requisicoes(_limite_id(desde_ms, False), _limite_id(ate_ms, True), tipo, limite)
+    return f"[{','.join(registros)}]".encode("utf-8")
 
 def gerar_codigo_python(descricao: str, usar_api: bool) -> dict:
     """Gera código Python baseado na descrição"""
@@ -402,6 +577,1415 @@ OUT = f"Total de elementos: {{len(list(elementos))}}"'''
     }
 
 
+# ============================================
+# RENDERIZAÇÃO DO BEP
+# ============================================
+
+# Diretório onde os documentos gerados ficam disponíveis para download
+ARQUIVOS_DIR = os.getenv(
+    "JOHN_ARQUIVOS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "arquivos_gerados")
+)
+
+# Processos dedicados à renderização (fora do event loop)
+BEP_WORKERS = int(os.getenv("JOHN_BEP_WORKERS", "2"))
+
+BEP_FORMATOS = ("pdf", "docx")
+
+BEP_DISCIPLINAS_PADRAO = ["Arquitetura", "Estrutura", "MEP"]
+
+# Colunas da matriz de responsabilidades
+BEP_ATIVIDADES = ("Modelagem", "Documentação", "Quantitativos", "Compatibilização", "Entrega IFC")
+
+# R = Responsável, A = Aprova, C = Consultado, I = Informado
+BEP_PAPEIS_POR_DISCIPLINA = {
+    "arquitetura": ("R", "R", "C", "A", "R"),
+    "estrutura": ("R", "R", "R", "C", "R"),
+    "mep": ("R", "R", "R", "C", "R"),
+    "hidraulica": ("R", "R", "R", "C", "R"),
+    "eletrica": ("R", "R", "R", "C", "R"),
+    "coordenacao": ("I", "A", "A", "R", "A"),
+    "orcamento": ("I", "I", "R", "I", "I"),
+}
+BEP_PAPEIS_PADRAO = ("R", "R", "C", "C", "R")
+
+# Seções do BEP: (título, estática, linhas do template)
+# Seções estáticas dependem só do tipo de projeto e são reaproveitadas entre projetos
+BEP_SECOES = (
+    ("Informações do Projeto", False, (
+        "Projeto: $nome_projeto",
+        "Cliente: $cliente",
+        "Tipo de projeto: $tipo_projeto",
+        "Disciplinas envolvidas: $disciplinas",
+        "Emitido em: $data_emissao",
+        "Identificador: $id_requisicao",
+    )),
+    ("Objetivos BIM", True, (
+        "Coordenar as disciplinas do projeto $tipo_projeto a partir de um modelo federado único.",
+        "Reduzir retrabalho em obra com compatibilização e detecção de interferências antes de cada entrega.",
+        "Extrair quantitativos diretamente dos modelos para orçamento e planejamento.",
+        "Entregar ao proprietário um modelo as built apto à operação e manutenção.",
+    )),
+    ("Usos do Modelo BIM", True, (
+        "Modelagem das condições existentes e do projeto $tipo_projeto.",
+        "Coordenação 3D e clash detection entre disciplinas.",
+        "Extração de quantitativos (4D/5D) e emissão de documentação.",
+        "Validação de requisitos normativos e de acessibilidade.",
+    )),
+    ("Matriz de Responsabilidades", False, (
+        "Legenda: R = Responsável, A = Aprova, C = Consultado, I = Informado.",
+    )),
+    ("Requisitos de Entrega", True, (
+        "Modelos nativos Revit (.rvt) e exportação IFC4 Coordination View a cada marco.",
+        "LOD mínimo 300 no projeto executivo e 500 no as built do projeto $tipo_projeto.",
+        "Pranchas em PDF e quantitativos em planilha Excel vinculados ao modelo.",
+    )),
+    ("Padrões e Protocolos", True, (
+        "Classificação da informação conforme NBR 15965.",
+        "Gestão da informação e ambiente comum de dados (CDE) conforme ISO 19650.",
+        "Nomenclatura de arquivos: PROJETO-DISCIPLINA-ZONA-NIVEL-TIPO-NUMERO.",
+    )),
+    ("Infraestrutura Tecnológica", True, (
+        "Autodesk Revit 2024 para modelagem e Navisworks para coordenação.",
+        "Dynamo 2.x para automação de rotinas de modelagem e documentação.",
+        "CDE em nuvem com controle de versões e permissões por disciplina.",
+    )),
+    ("Controle de Qualidade", True, (
+        "Auditoria de modelo antes de cada entrega (warnings, purge e nomenclatura).",
+        "Clash detection semanal entre disciplinas com relatório de pendências.",
+        "Validação IFC e checklist BIM por fase do projeto.",
+    )),
+)
+
+# Templates pré-compilados uma única vez por processo
+_BEP_TEMPLATES = {
+    titulo: (estatica, tuple(Template(linha) for linha in linhas))
+    for titulo, estatica, linhas in BEP_SECOES
+}
+
+
+def _renderizar_secao_estatica(titulo: str, tipo_projeto: str) -> tuple:
+    """Parágrafos de uma seção estática (depende só do tipo de projeto)"""
+    _, templates = _BEP_TEMPLATES[titulo]
+    return tuple(("paragrafo", t.safe_substitute(tipo_projeto=tipo_projeto)) for t in templates)
+
+def _montar_matriz_responsabilidades(disciplinas: List[str]) -> tuple:
+    """Monta a matriz de responsabilidades por disciplina"""
+    linhas = tuple(
+        (disciplina,) + BEP_PAPEIS_POR_DISCIPLINA.get(normalizar_chave(disciplina), BEP_PAPEIS_PADRAO)
+        for disciplina in disciplinas
+    )
+    return ("tabela", ("Disciplina",) + BEP_ATIVIDADES, linhas)
+
+def montar_documento_bep(dados: dict) -> list:
+    """Monta os blocos do documento BEP a partir dos templates"""
+    valores = dict(dados, disciplinas=", ".join(dados["disciplinas"]))
+    blocos = [("titulo", f"BIM Execution Plan - {dados['nome_projeto']}")]
+
+    for numero, (titulo, (estatica, templates)) in enumerate(_BEP_TEMPLATES.items(), 1):
+        blocos.append(("secao", f"{numero}. {titulo}"))
+        if estatica:
+            # Renderizada uma vez por formato e tipo de projeto (ver _secao_estatica_pdf/_docx)
+            blocos.append(("estatica", titulo, dados["tipo_projeto"]))
+            continue
+        blocos.extend(("paragrafo", t.safe_substitute(valores)) for t in templates)
+        if titulo == "Matriz de Responsabilidades":
+            blocos.append(_montar_matriz_responsabilidades(dados["disciplinas"]))
+
+    return blocos
+
+def _linhas_tabela(cabecalho: tuple, linhas: tuple) -> List[str]:
+    """Formata tabela em colunas de largura fixa"""
+    larguras = [max(len(linha[i]) for linha in (cabecalho,) + linhas) for i in range(len(cabecalho))]
+    formatar = lambda linha: "  ".join(c.ljust(l) for c, l in zip(linha, larguras))
+    return [formatar(cabecalho), "  ".join("-" * l for l in larguras)] + [formatar(l) for l in linhas]
+
+# Estilo PDF: (fonte, tamanho, entrelinha)
+_PDF_ESTILOS = {
+    "titulo": (b"F2", 16, 28),
+    "secao": (b"F2", 12, 22),
+    "paragrafo": (b"F1", 10, 14),
+    "tabela": (b"F3", 9, 12),
+}
+
+def _pdf_texto(texto: str) -> bytes:
+    """Escapa texto para string literal PDF (WinAnsiEncoding)"""
+    escapado = texto.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    return escapado.encode("cp1252", errors="replace")
+
+_PDF_LARGURA, _PDF_ALTURA, _PDF_MARGEM = 595, 842, 50
+
+def _pdf_operacao(estilo: str, texto: str) -> tuple:
+    """Operação de texto PDF sem a posição vertical: (entrelinha, prefixo, sufixo)"""
+    fonte, tamanho, entrelinha = _PDF_ESTILOS[estilo]
+    return (entrelinha, b"BT /%s %d Tf %d " % (fonte, tamanho, _PDF_MARGEM), b" Td (%s) Tj ET" % _pdf_texto(texto))
+
+def _pdf_operacoes(bloco: tuple) -> List[tuple]:
+    """Quebra e escapa um bloco em operações de texto PDF"""
+    if bloco[0] == "tabela":
+        return [_pdf_operacao("tabela", linha) for linha in _linhas_tabela(bloco[1], bloco[2])]
+    if bloco[0] == "paragrafo":
+        return [_pdf_operacao("paragrafo", linha) for linha in textwrap.wrap(bloco[1], 95) or [""]]
+    return [_pdf_operacao(bloco[0], bloco[1])]
+
+@lru_cache(maxsize=256)
+def _secao_estatica_pdf(titulo: str, tipo_projeto: str) -> tuple:
+    """Operações PDF de uma seção estática, cacheadas entre projetos do mesmo tipo"""
+    return tuple(op for bloco in _renderizar_secao_estatica(titulo, tipo_projeto) for op in _pdf_operacoes(bloco))
+
+def _renderizar_pdf(blocos: list) -> bytes:
+    """Gera PDF A4 simples com fontes padrão"""
+    largura, altura, margem = _PDF_LARGURA, _PDF_ALTURA, _PDF_MARGEM
+    paginas: List[List[bytes]] = [[]]
+    y = altura - margem
+
+    # Só a paginação é feita por documento; quebra de linha e escape das
+    # seções estáticas vêm do cache
+    for bloco in blocos:
+        operacoes = _secao_estatica_pdf(bloco[1], bloco[2]) if bloco[0] == "estatica" else _pdf_operacoes(bloco)
+        for entrelinha, prefixo, sufixo in operacoes:
+            if y - entrelinha < margem:
+                paginas.append([])
+                y = altura - margem
+            y -= entrelinha
+            paginas[-1].append(prefixo + b"%d" % y + sufixo)
+
+    # Objetos 1 e 2 (catálogo e páginas) são preenchidos ao final
+    objetos: List[bytes] = [b"", b""]
+    for nome in (b"Helvetica", b"Helvetica-Bold", b"Courier"):
+        objetos.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>" % nome)
+    recursos = b"<< /Font << /F1 3 0 R /F2 4 0 R /F3 5 0 R >> >>"
+
+    kids = []
+    for comandos in paginas:
+        conteudo = b"\n".join(comandos)
+        objetos.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(conteudo), conteudo))
+        objetos.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Resources %s /Contents %d 0 R >>"
+            % (largura, altura, recursos, len(objetos))
+        )
+        kids.append(b"%d 0 R" % len(objetos))
+    objetos[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objetos[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(kids), len(kids))
+
+    saida = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for numero, corpo in enumerate(objetos, 1):
+        offsets.append(len(saida))
+        saida += b"%d 0 obj\n%s\nendobj\n" % (numero, corpo)
+    inicio_xref = len(saida)
+    saida += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objetos) + 1)
+    saida += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    saida += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objetos) + 1, inicio_xref)
+    return bytes(saida)
+
+_DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>'
+)
+
+_DOCX_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="word/document.xml"/>'
+    '</Relationships>'
+)
+
+def _docx_paragrafo(texto: str, negrito: bool = False, tamanho: Optional[int] = None) -> str:
+    """Gera parágrafo WordprocessingML"""
+    props = ("<w:b/>" if negrito else "") + (f'<w:sz w:val="{tamanho * 2}"/>' if tamanho else "")
+    props = f"<w:rPr>{props}</w:rPr>" if props else ""
+    return f'<w:p><w:r>{props}<w:t xml:space="preserve">{escape(texto)}</w:t></w:r></w:p>'
+
+def _docx_tabela(cabecalho: tuple, linhas: tuple) -> str:
+    """Gera tabela WordprocessingML com bordas simples"""
+    bordas = "".join(
+        f'<w:{lado} w:val="single" w:sz="4" w:space="0" w:color="auto"/>'
+        for lado in ("top", "left", "bottom", "right", "insideH", "insideV")
+    )
+    grid = '<w:gridCol w:w="1800"/>' * len(cabecalho)
+    linha_xml = lambda celulas, negrito: "<w:tr>" + "".join(
+        f"<w:tc>{_docx_paragrafo(c, negrito)}</w:tc>" for c in celulas
+    ) + "</w:tr>"
+    return (
+        f'<w:tbl><w:tblPr><w:tblW w:w="0" w:type="auto"/><w:tblBorders>{bordas}</w:tblBorders></w:tblPr>'
+        f"<w:tblGrid>{grid}</w:tblGrid>"
+        + linha_xml(cabecalho, True)
+        + "".join(linha_xml(l, False) for l in linhas)
+        + "</w:tbl>"
+    )
+
+@lru_cache(maxsize=256)
+def _secao_estatica_docx(titulo: str, tipo_projeto: str) -> str:
+    """XML de uma seção estática, cacheado entre projetos do mesmo tipo"""
+    return "".join(_docx_paragrafo(texto) for _, texto in _renderizar_secao_estatica(titulo, tipo_projeto))
+
+def _renderizar_docx(blocos: list) -> bytes:
+    """Gera DOCX mínimo (OOXML) sem dependências externas"""
+    corpo = []
+    for bloco in blocos:
+        if bloco[0] == "estatica":
+            corpo.append(_secao_estatica_docx(bloco[1], bloco[2]))
+        elif bloco[0] == "titulo":
+            corpo.append(_docx_paragrafo(bloco[1], negrito=True, tamanho=16))
+        elif bloco[0] == "secao":
+            corpo.append(_docx_paragrafo(bloco[1], negrito=True, tamanho=12))
+        elif bloco[0] == "tabela":
+            corpo.append(_docx_tabela(bloco[1], bloco[2]))
+        else:
+            corpo.append(_docx_paragrafo(bloco[1]))
+
+    documento = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+        f'<w:body>{"".join(corpo)}</w:body></w:document>'
+    )
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as pacote:
+        pacote.writestr("[Content_Types].xml", _DOCX_CONTENT_TYPES)
+        pacote.writestr("_rels/.rels", _DOCX_RELS)
+        pacote.writestr("word/document.xml", documento)
+    return buffer.getvalue()
+
+def renderizar_bep(dados: dict, formato: str, caminho: str) -> int:
+    """Renderiza o BEP e grava em disco (executado no pool de processos)"""
+    blocos = montar_documento_bep(dados)
+    conteudo = _renderizar_pdf(blocos) if formato == "pdf" else _renderizar_docx(blocos)
+
+    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    temporario = f"{caminho}.tmp"
+    with open(temporario, "wb") as f:
+        f.write(conteudo)
+    os.replace(temporario, caminho)
+    return len(conteudo)
+
+
+# Pool criado sob demanda para não custar nada a quem não gera BEP
+_bep_pool: Optional[ProcessPoolExecutor] = None
+
+def obter_pool_bep() -> ProcessPoolExecutor:
+    """Retorna o pool de processos de renderização"""
+    global _bep_pool
+    if _bep_pool is None:
+        # forkserver: os processos de renderização não herdam por fork as
+        # threads do worker (diário, webhooks) nem o estado do event loop
+        metodos = multiprocessing.get_all_start_methods()
+        contexto = multiprocessing.get_context("forkserver" if "forkserver" in metodos else None)
+        _bep_pool = ProcessPoolExecutor(max_workers=BEP_WORKERS, mp_context=contexto)
+    return _bep_pool
+
+@app.on_event("shutdown")
+def encerrar_pool_bep():
+    """Encerra o pool de renderização junto com o servidor"""
+    global _bep_pool
+    if _bep_pool is not None:
+        _bep_pool.shutdown(wait=False, cancel_futures=True)
+        _bep_pool = None
+
+
+# ============================================
+# MATRIZ DE REGRAS DO CHECKLIST
+# ============================================
+
+# Arquivo JSON opcional com itens específicos da empresa, no formato:
+# [{"fase": "executivo", "disciplina": "mep", "tipo_projeto": "*",
+#   "categoria": "MEP", "item": "...", "obrigatorio": true}]
+CHECKLIST_REGRAS_ARQUIVO = os.getenv("JOHN_CHECKLIST_REGRAS")
+
+# Curinga: a regra vale para qualquer fase, disciplina ou tipo de projeto
+QUALQUER = "*"
+
+CHECKLIST_ITENS_POR_FASE = {
+    "concepcao": [
+        "Volume geral do edifício definido",
+        "Níveis principais criados",
+        "Grid estrutural básico",
+        "Estudo de massas concluído"
+    ],
+    "anteprojeto": [
+        "Paredes externas modeladas",
+        "Esquadrias principais posicionadas",
+        "Circulações verticais definidas",
+        "Cobertura modelada"
+    ],
+    "projeto_legal": [
+        "Áreas calculadas e verificadas",
+        "Cotas de nível conferidas",
+        "Acessibilidade verificada (NBR 9050)",
+        "Recuos e afastamentos conferidos"
+    ],
+    "executivo": [
+        "Detalhamento completo",
+        "Quantitativos extraídos",
+        "Compatibilização realizada",
+        "Pranchas geradas"
+    ],
+    "as_built": [
+        "Modelo atualizado conforme construído",
+        "Informações de fabricantes incluídas",
+        "Documentação de manutenção anexada",
+        "Entrega para operação preparada"
+    ]
+}
+
+# Regras: (fase, disciplina, tipo_projeto, categoria, item, obrigatório)
+# A ordem das categorias no checklist segue a primeira aparição nesta lista
+CHECKLIST_REGRAS_PADRAO = [
+    (fase, QUALQUER, QUALQUER, "Verificações Gerais", item, True)
+    for fase, itens in CHECKLIST_ITENS_POR_FASE.items()
+    for item in itens
+] + [
+    ("anteprojeto", "arquitetura", QUALQUER, "Arquitetura", "Layout dos ambientes aprovado", True),
+    ("executivo", "arquitetura", QUALQUER, "Arquitetura", "Paginação de pisos e revestimentos detalhada", False),
+    ("anteprojeto", "estrutura", QUALQUER, "Estrutura", "Pré-dimensionamento de pilares e vigas", True),
+    ("executivo", "estrutura", QUALQUER, "Estrutura", "Armaduras detalhadas conforme NBR 6118", True),
+    ("executivo", "estrutura", QUALQUER, "Estrutura", "Cobrimentos verificados", True),
+    ("anteprojeto", "mep", QUALQUER, "MEP", "Shafts e prumadas reservados", True),
+    ("executivo", "mep", QUALQUER, "MEP", "Clash detection MEP x Estrutura sem interferências", True),
+    ("executivo", "mep", QUALQUER, "MEP", "Sistemas conectados e com fluxo verificado", True),
+    ("as_built", "mep", QUALQUER, "MEP", "Equipamentos com dados de manutenção (COBie)", False),
+    ("executivo", "coordenacao", QUALQUER, "Coordenação", "Modelo federado atualizado", True),
+    ("executivo", "coordenacao", QUALQUER, "Coordenação", "Relatório de interferências emitido", True),
+    ("projeto_legal", QUALQUER, "residencial", "Verificações Gerais", "Áreas privativas por unidade conferidas", True),
+    ("projeto_legal", QUALQUER, "comercial", "Verificações Gerais", "Rotas de fuga dimensionadas", True),
+    ("executivo", QUALQUER, "industrial", "Verificações Gerais", "Rotas de manutenção de equipamentos verificadas", True),
+    (QUALQUER, QUALQUER, QUALQUER, "Qualidade do Modelo", "Warnings abaixo de 100", True),
+    (QUALQUER, QUALQUER, QUALQUER, "Qualidade do Modelo", "Purge Unused executado", True),
+    (QUALQUER, QUALQUER, QUALQUER, "Qualidade do Modelo", "Audit realizado", False),
+    (QUALQUER, QUALQUER, QUALQUER, "Qualidade do Modelo", "Nomenclatura padronizada", True),
+]
+
+def _carregar_regras_checklist() -> list:
+    """Carrega as regras padrão e as regras específicas da empresa"""
+    regras = list(CHECKLIST_REGRAS_PADRAO)
+
+    if CHECKLIST_REGRAS_ARQUIVO:
+        with open(CHECKLIST_REGRAS_ARQUIVO, encoding="utf-8") as f:
+            for regra in json.load(f):
+                regras.append((
+                    regra.get("fase", QUALQUER),
+                    regra.get("disciplina", QUALQUER),
+                    regra.get("tipo_projeto", QUALQUER),
+                    regra["categoria"],
+                    regra["item"],
+                    regra.get("obrigatorio", True)
+                ))
+
+    return [
+        tuple(QUALQUER if v == QUALQUER else normalizar_chave(v) for v in regra[:3]) + regra[3:]
+        for regra in regras
+    ]
+
+def _indexar_fragmentos(regras: list) -> Dict[tuple, tuple]:
+    """Pré-computa os fragmentos do checklist por (fase, disciplina, tipo_projeto)"""
+    ordem_categorias: Dict[str, int] = {}
+    fragmentos: Dict[tuple, list] = {}
+
+    for indice, (fase, disciplina, tipo_projeto, categoria, item, obrigatorio) in enumerate(regras):
+        ordem = ordem_categorias.setdefault(categoria, len(ordem_categorias))
+        fragmentos.setdefault((fase, disciplina, tipo_projeto), []).append(
+            ((ordem, indice), categoria, (item, obrigatorio))
+        )
+
+    return {chave: tuple(itens) for chave, itens in fragmentos.items()}
+
+# Matriz carregada uma única vez por processo
+_CHECKLIST_FRAGMENTOS = _indexar_fragmentos(_carregar_regras_checklist())
+CHECKLIST_FASES = tuple(sorted({fase for fase, _, _ in _CHECKLIST_FRAGMENTOS if fase != QUALQUER}))
+
+
+@lru_cache(maxsize=1024)
+def compor_checklist(tipo_projeto: str, fase: str, disciplinas: tuple) -> tuple:
+    """Compõe os itens do checklist (chave já normalizada e ordenada, sem curingas)
+
+    Retorna tuplas imutáveis ((categoria, ((item, obrigatorio), ...)), ...): o
+    resultado fica no cache e é compartilhado entre requisições.
+    """
+    encontrados = []
+    for f in (fase, QUALQUER):
+        for d in (QUALQUER,) + disciplinas:
+            for t in (tipo_projeto, QUALQUER):
+                encontrados.extend(_CHECKLIST_FRAGMENTOS.get((f, d, t), ()))
+
+    # Agrupa por categoria mantendo a ordem das regras dentro de cada uma
+    encontrados.sort(key=lambda fragmento: fragmento[0])
+
+    itens: List[tuple] = []
+    for _, categoria, verificacao in encontrados:
+        if not itens or itens[-1][0] != categoria:
+            itens.append((categoria, []))
+        itens[-1][1].append(verificacao)
+
+    return tuple((categoria, tuple(verificacoes)) for categoria, verificacoes in itens)
+
+
+# ============================================
+# TEXTOS DAS NORMAS
+# ============================================
+
+# Um arquivo UTF-8 por norma (<codigo>.txt); cada seção começa com uma linha "## <número> <título>"
+NORMAS_DIR = os.getenv(
+    "JOHN_NORMAS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "normas")
+)
+
+NORMAS_MARCADOR_SECAO = re.compile(rb"^## (\S+)[ \t]*([^\r\n]*)\r?\n", re.MULTILINE)
+
+
+class DocumentoNorma:
+    """Texto de uma norma via mmap: só o índice de seções fica em memória"""
+
+    __slots__ = ("_mm", "secoes", "_posicoes")
+
+    def __init__(self, caminho: str):
+        with open(caminho, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # (seção, título, início do texto, fim do texto)
+        marcadores = list(NORMAS_MARCADOR_SECAO.finditer(self._mm))
+        self.secoes = []
+        for i, marcador in enumerate(marcadores):
+            fim = marcadores[i + 1].start() if i + 1 < len(marcadores) else len(self._mm)
+            self.secoes.append((
+                marcador.group(1).decode("utf-8"),
+                marcador.group(2).decode("utf-8").strip(),
+                marcador.end(),
+                fim
+            ))
+        self._posicoes = {secao[0]: posicao for posicao, secao in enumerate(self.secoes)}
+
+    def posicao(self, secao: str) -> Optional[int]:
+        return self._posicoes.get(secao)
+
+    def texto(self, posicao: int) -> str:
+        """Lê do arquivo apenas o trecho da seção"""
+        _, _, inicio, fim = self.secoes[posicao]
+        return self._mm[inicio:fim].decode("utf-8").strip()
+
+
+# Documentos abertos sob demanda por processo (None = norma sem texto disponível)
+_documentos_normas: Dict[str, Optional[DocumentoNorma]] = {}
+
+def obter_documento_norma(codigo: str) -> Optional[DocumentoNorma]:
+    """Abre e indexa o texto da norma no primeiro acesso"""
+    if codigo not in _documentos_normas:
+        caminho = os.path.join(NORMAS_DIR, f"{codigo}.txt")
+        documento = None
+        if os.path.isfile(caminho) and os.path.getsize(caminho) > 0:
+            documento = DocumentoNorma(caminho)
+        _documentos_normas[codigo] = documento
+    return _documentos_normas[codigo]
+
+
+# ============================================
+# WEBHOOKS
+# ============================================
+
+WEBHOOK_TRABALHADORES = int(os.getenv("JOHN_WEBHOOK_TRABALHADORES", "8"))
+WEBHOOK_POR_HOST = int(os.getenv("JOHN_WEBHOOK_POR_HOST", "4"))
+WEBHOOK_MAX_TENTATIVAS = int(os.getenv("JOHN_WEBHOOK_MAX_TENTATIVAS", "5"))
+WEBHOOK_FILA_MAX = 10000
+WEBHOOK_TIMEOUT_SEGUNDOS = 10.0
+WEBHOOK_BACKOFF_SEGUNDOS = 1.0
+WEBHOOK_BACKOFF_MAX_SEGUNDOS = 300.0
+
+# Hosts aceitos em callback_url, separados por vírgula. Vazio: qualquer host
+# que resolva apenas para endereços públicos (sem loopback, rede privada,
+# link-local/metadados de nuvem). Hosts listados podem estar na rede interna.
+WEBHOOK_HOSTS_PERMITIDOS = frozenset(
+    host.strip().lower().rstrip(".")
+    for host in os.getenv("JOHN_WEBHOOK_HOSTS_PERMITIDOS", "").split(",")
+    if host.strip()
+)
+
+def endereco_publico(endereco: str) -> bool:
+    """Endereço IP roteável na internet (rejeita loopback, privados, link-local etc.)"""
+    ip = ipaddress.ip_address(endereco.split("%")[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+def verificar_host_webhook(host: str) -> Optional[str]:
+    """Motivo da recusa do host de callback_url, ou None se aceito"""
+    host = host.lower().rstrip(".")
+    if WEBHOOK_HOSTS_PERMITIDOS:
+        return None if host in WEBHOOK_HOSTS_PERMITIDOS else "callback_url fora dos hosts permitidos"
+    if host == "localhost" or host.endswith(".localhost"):
+        return "callback_url não pode apontar para a rede interna"
+    try:
+        publico = endereco_publico(host)
+    except ValueError:
+        # Nome de host: verificado na resolução, a cada entrega
+        return None
+    return None if publico else "callback_url não pode apontar para a rede interna"
+
+
+class DestinoBloqueado(Exception):
+    """Host de callback resolvido para endereço não público"""
+
+
+class BackendDestinoVerificado(httpcore.AsyncNetworkBackend):
+    """
+    Rede do pool de webhooks: resolve o host, recusa endereços internos e
+    conecta no endereço verificado. A resolução e a conexão acontecem no mesmo
+    passo (sem janela para DNS rebinding), e o pool continua indexado pelo
+    nome do host, então TLS e reuso de conexões keep-alive seguem o host real.
+    """
+    
+    def __init__(self):
+        self._rede = httpcore.AnyIOBackend()
+    
+    async def connect_tcp(self, host: str, port: int, timeout: Optional[float] = None,
+                          local_address: Optional[str] = None, socket_options=None):
+        if host.lower().rstrip(".") not in WEBHOOK_HOSTS_PERMITIDOS:
+            resolvidos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            enderecos = [info[4][0] for info in resolvidos]
+            if not enderecos or not all(endereco_publico(endereco) for endereco in enderecos):
+                raise DestinoBloqueado(f"callback_url resolve para endereço interno ({host})")
+            host = enderecos[0]
+        return await self._rede.connect_tcp(host, port, timeout, local_address, socket_options)
+    
+    async def connect_unix_socket(self, path: str, timeout: Optional[float] = None, socket_options=None):
+        raise DestinoBloqueado("callback_url não aceita socket unix")
+    
+    async def sleep(self, seconds: float):
+        await self._rede.sleep(seconds)
+
+
+class TransporteWebhooks(httpx.AsyncHTTPTransport):
+    """Transporte httpx sobre o BackendDestinoVerificado"""
+    
+    def __init__(self, limits: httpx.Limits):
+        super().__init__(limits=limits)
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            network_backend=BackendDestinoVerificado()
+        )
+
+class FilaWebhooks:
+    """
+    Fila assíncrona de entrega dos callbacks de conclusão.
+    
+    Usa um pool de conexões keep-alive compartilhado, limita a concorrência
+    por host, refaz entregas com backoff exponencial e guarda as que
+    esgotaram as tentativas na lista de falhas (dead letter).
+    """
+    
+    def __init__(self, trabalhadores: int = WEBHOOK_TRABALHADORES, por_host: int = WEBHOOK_POR_HOST,
+                 max_tentativas: int = WEBHOOK_MAX_TENTATIVAS, max_falhas: int = 1000):
+        self.trabalhadores = trabalhadores
+        self.por_host = por_host
+        self.max_tentativas = max_tentativas
+        self.max_falhas = max_falhas
+        self._fila: Optional[asyncio.Queue] = None
+        self._cliente: Optional[httpx.AsyncClient] = None
+        self._tarefas: List[asyncio.Task] = []
+        # host -> [semáforo, entregas em andamento]; removido quando ocioso
+        self._semaforos: Dict[str, list] = {}
+    
+    @property
+    def falhas(self) -> List[dict]:
+        """Dead letter de todos os workers, da mais antiga para a mais recente"""
+        return estado_db.falhas_webhook()
+    
+    async def iniciar(self):
+        self._fila = asyncio.Queue(maxsize=WEBHOOK_FILA_MAX)
+        # trust_env=False: proxies do ambiente não podem contornar a verificação de destino
+        self._cliente = httpx.AsyncClient(
+            timeout=WEBHOOK_TIMEOUT_SEGUNDOS,
+            trust_env=False,
+            transport=TransporteWebhooks(httpx.Limits(
+                max_connections=self.trabalhadores * 2, max_keepalive_connections=self.trabalhadores
+            ))
+        )
+        self._tarefas = [asyncio.create_task(self._trabalhador()) for _ in range(self.trabalhadores)]
+    
+    async def encerrar(self):
+        for tarefa in self._tarefas:
+            tarefa.cancel()
+        await asyncio.gather(*self._tarefas, return_exceptions=True)
+        self._tarefas = []
+        if self._cliente is not None:
+            await self._cliente.aclose()
+        self._fila = self._cliente = None
+    
+    def agendar(self, url: str, registro: dict):
+        """Enfileira a entrega sem bloquear o handler"""
+        entrega = {
+            "url": url,
+            "id_requisicao": registro["id_requisicao"],
+            "corpo": json.dumps(registro, ensure_ascii=False, default=str).encode("utf-8"),
+            "tentativas": 0
+        }
+        if self._fila is None:
+            return self._descartar(entrega, "fila de webhooks não iniciada")
+        try:
+            self._fila.put_nowait(entrega)
+        except asyncio.QueueFull:
+            self._descartar(entrega, "fila de webhooks cheia")
+    
+    async def _trabalhador(self):
+        while True:
+            entrega = await self._fila.get()
+            try:
+                await self._entregar(entrega)
+            except Exception as erro:
+                self._descartar(entrega, f"erro interno: {erro!r}")
+            finally:
+                self._fila.task_done()
+    
+    async def _entregar(self, entrega: dict):
+        entrega["tentativas"] += 1
+        host = urlsplit(entrega["url"]).netloc
+        por_host = self._semaforos.setdefault(host, [asyncio.Semaphore(self.por_host), 0])
+        por_host[1] += 1
+        
+        try:
+            async with por_host[0]:
+                try:
+                    resposta = await self._cliente.post(entrega["url"], content=entrega["corpo"], headers={
+                        "Content-Type": "application/json",
+                        "X-John-Evento": "requisicao.concluida",
+                        "X-John-Requisicao": entrega["id_requisicao"],
+                        "X-John-Tentativa": str(entrega["tentativas"])
+                    })
+                    if resposta.status_code < 300:
+                        return
+                    erro = f"HTTP {resposta.status_code}"
+                except DestinoBloqueado as excecao:
+                    # Sem retentativa: o destino não é aceito
+                    return self._descartar(entrega, str(excecao))
+                except (httpx.HTTPError, OSError) as excecao:
+                    erro = f"{type(excecao).__name__}: {excecao}"
+        finally:
+            por_host[1] -= 1
+            if not por_host[1]:
+                del self._semaforos[host]
+        
+        if entrega["tentativas"] >= self.max_tentativas:
+            return self._descartar(entrega, erro)
+        
+        # Retentativa agendada fora do trabalhador, que segue livre para outras entregas
+        atraso = min(WEBHOOK_BACKOFF_SEGUNDOS * 2 ** (entrega["tentativas"] - 1), WEBHOOK_BACKOFF_MAX_SEGUNDOS)
+        asyncio.get_running_loop().call_later(atraso * random.uniform(0.5, 1.0), self._reenfileirar, entrega)
+    
+    def _reenfileirar(self, entrega: dict):
+        if self._fila is None:
+            return self._descartar(entrega, "fila de webhooks encerrada")
+        try:
+            self._fila.put_nowait(entrega)
+        except asyncio.QueueFull:
+            self._descartar(entrega, "fila de webhooks cheia")
+    
+    def _descartar(self, entrega: dict, motivo: str):
+        estado_db.registrar_falha_webhook({
+            "id_requisicao": entrega["id_requisicao"],
+            "callback_url": entrega["url"],
+            "tentativas": entrega["tentativas"],
+            "erro": motivo,
+            "falhou_em": datetime.now().isoformat()
+        }, self.max_falhas)
+
+fila_webhooks = FilaWebhooks()
+
+@app.on_event("startup")
+async def iniciar_fila_webhooks():
+    """Inicia os trabalhadores de entrega de webhooks"""
+    await fila_webhooks.iniciar()
+
+@app.on_event("shutdown")
+async def encerrar_fila_webhooks():
+    """Encerra os trabalhadores e o pool de conexões"""
+    await fila_webhooks.encerrar()
+
+
+# ============================================
+# MIDDLEWARES
+# ============================================
+
+async def enviar_json(send, status: int, dados: dict, headers: Optional[List[tuple]] = None):
+    """Envia resposta JSON diretamente pela interface ASGI"""
+    corpo = json.dumps(dados, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(corpo)).encode())
+        ] + (headers or [])
+    })
+    await send({"type": "http.response.body", "body": corpo})
+
+def obter_header(scope: dict, nome: bytes) -> Optional[bytes]:
+    """Retorna o valor de um header da requisição ASGI"""
+    for chave, valor in scope["headers"]:
+        if chave == nome:
+            return valor
+    return None
+
+
+# --- Controle de admissão ---
+# Classes de prioridade: quanto do limite adaptativo cada classe pode ocupar
+PRIORIDADE_CRITICA = "critica"
+PRIORIDADE_NORMAL = "normal"
+PRIORIDADE_PESADA = "pesada"
+
+ADMISSAO_FRACAO_LIMITE = {PRIORIDADE_CRITICA: 1.0, PRIORIDADE_NORMAL: 0.8, PRIORIDADE_PESADA: 0.5}
+ADMISSAO_CUSTO_TOKENS = {PRIORIDADE_CRITICA: 1.0, PRIORIDADE_NORMAL: 1.0, PRIORIDADE_PESADA: 5.0}
+
+# (método, prefixo da rota, prioridade) - primeira correspondência vale
+ADMISSAO_ROTAS = (
+    ("GET", "/health", PRIORIDADE_CRITICA),
+    ("GET", "/status/", PRIORIDADE_CRITICA),
+    ("POST", "/auditoria/modelo", PRIORIDADE_PESADA),
+    ("POST", "/ifc/validar", PRIORIDADE_PESADA),
+    ("POST", "/quantitativos/extrair", PRIORIDADE_PESADA),
+    ("POST", "/relatorios/bep", PRIORIDADE_PESADA),
+)
+# Consultas (GET) são baratas; demais POSTs são trabalho normal
+ADMISSAO_PADRAO_POR_METODO = {"GET": PRIORIDADE_CRITICA, "HEAD": PRIORIDADE_CRITICA}
+
+# "0" desativa o controle de admissão (ex.: reprodução do diário em processo,
+# em que todas as requisições chegam de um único cliente)
+ADMISSAO_ATIVA = os.getenv("JOHN_ADMISSAO_ATIVA", "1") != "0"
+ADMISSAO_TAXA_CLIENTE = float(os.getenv("JOHN_ADMISSAO_TAXA", "20"))
+ADMISSAO_RAJADA_CLIENTE = float(os.getenv("JOHN_ADMISSAO_RAJADA", "40"))
+ADMISSAO_LIMITE_INICIAL = float(os.getenv("JOHN_ADMISSAO_LIMITE_INICIAL", "32"))
+ADMISSAO_LIMITE_MIN = 4.0
+ADMISSAO_LIMITE_MAX = float(os.getenv("JOHN_ADMISSAO_LIMITE_MAX", "256"))
+ADMISSAO_TOLERANCIA_RTT = 1.5
+ADMISSAO_MAX_CLIENTES = 10000
+
+def prioridade_da_rota(metodo: str, caminho: str) -> str:
+    """Classe de prioridade de uma rota"""
+    for metodo_rota, prefixo, prioridade in ADMISSAO_ROTAS:
+        if metodo == metodo_rota and caminho.startswith(prefixo):
+            return prioridade
+    return ADMISSAO_PADRAO_POR_METODO.get(metodo, PRIORIDADE_NORMAL)
+
+class AdmissaoMiddleware:
+    """
+    Controle de admissão e descarte de carga.
+    
+    Cada cliente tem um balde de tokens (429 ao esgotar). O limite global de
+    requisições simultâneas se adapta à latência medida (gradiente entre RTT
+    de longo e curto prazo); acima da fração do limite permitida para sua
+    classe, a requisição é descartada cedo com 503.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+        self.limite = ADMISSAO_LIMITE_INICIAL
+        self.em_andamento = 0
+        self._rtt_curto: Optional[float] = None
+        self._rtt_longo: Optional[float] = None
+        # cliente -> [tokens, último abastecimento]
+        self._baldes: "OrderedDict[str, list]" = OrderedDict()
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        
+        prioridade = prioridade_da_rota(scope["method"], scope["path"])
+        
+        espera = self._consumir_tokens(self._cliente(scope), ADMISSAO_CUSTO_TOKENS[prioridade])
+        if espera > 0:
+            return await enviar_json(send, 429, {"detail": "Limite de requisições excedido"}, [
+                (b"retry-after", str(max(1, int(espera + 0.999))).encode())
+            ])
+        
+        if self.em_andamento >= int(self.limite * ADMISSAO_FRACAO_LIMITE[prioridade]):
+            return await enviar_json(send, 503, {"detail": "Servidor sobrecarregado, tente novamente"}, [
+                (b"retry-after", b"1")
+            ])
+        
+        self.em_andamento += 1
+        inicio = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.em_andamento -= 1
+            self._registrar_rtt(time.monotonic() - inicio)
+    
+    @staticmethod
+    def _cliente(scope: dict) -> str:
+        # X-Forwarded-For não é lido aqui: o uvicorn (proxy_headers) já reescreve
+        # o client a partir dele apenas quando a conexão vem de FORWARDED_ALLOW_IPS
+        return scope["client"][0] if scope.get("client") else "desconhecido"
+    
+    def _consumir_tokens(self, cliente: str, custo: float) -> float:
+        """Retorna 0 se admitido, ou os segundos até haver tokens suficientes"""
+        agora = time.monotonic()
+        balde = self._baldes.get(cliente)
+        if balde is None:
+            balde = self._baldes[cliente] = [ADMISSAO_RAJADA_CLIENTE, agora]
+            if len(self._baldes) > ADMISSAO_MAX_CLIENTES:
+                self._baldes.popitem(last=False)
+        else:
+            self._baldes.move_to_end(cliente)
+            balde[0] = min(ADMISSAO_RAJADA_CLIENTE, balde[0] + (agora - balde[1]) * ADMISSAO_TAXA_CLIENTE)
+            balde[1] = agora
+        
+        if balde[0] >= custo:
+            balde[0] -= custo
+            return 0.0
+        return (custo - balde[0]) / ADMISSAO_TAXA_CLIENTE
+    
+    def _registrar_rtt(self, rtt: float):
+        """Ajusta o limite pelo gradiente entre latência de longo e curto prazo"""
+        if self._rtt_curto is None:
+            self._rtt_curto = self._rtt_longo = rtt
+            return
+        self._rtt_curto = self._rtt_curto * 0.9 + rtt * 0.1
+        self._rtt_longo = self._rtt_longo * 0.99 + rtt * 0.01
+        # Se a latência caiu de forma sustentada, o longo prazo acompanha mais rápido
+        if self._rtt_longo > 2 * self._rtt_curto:
+            self._rtt_longo *= 0.95
+        
+        # Sem uso próximo ao limite não há evidência para aumentá-lo
+        if self.em_andamento < self.limite / 2 and self._rtt_curto <= self._rtt_longo:
+            return
+        
+        gradiente = max(0.5, min(1.0, ADMISSAO_TOLERANCIA_RTT * self._rtt_longo / self._rtt_curto))
+        novo_limite = self.limite * gradiente + self.limite ** 0.5
+        self.limite = max(ADMISSAO_LIMITE_MIN, min(ADMISSAO_LIMITE_MAX, self.limite * 0.8 + novo_limite * 0.2))
+
+if ADMISSAO_ATIVA:
+    app.add_middleware(AdmissaoMiddleware)
+
+
+# --- Idempotência ---
+IDEMPOTENCIA_TTL_SEGUNDOS = float(os.getenv("JOHN_IDEMPOTENCIA_TTL_SEGUNDOS", "3600"))
+IDEMPOTENCIA_MAX_ENTRADAS = int(os.getenv("JOHN_IDEMPOTENCIA_MAX_ENTRADAS", "10000"))
+# Reserva de uma execução em andamento: vencida (worker encerrado no meio), outra assume
+IDEMPOTENCIA_RESERVA_SEGUNDOS = 300.0
+# Intervalo de consulta enquanto outro worker executa a mesma chave
+IDEMPOTENCIA_ESPERA_SEGUNDOS = 0.05
+
+class IdempotenciaMiddleware:
+    """
+    Absorve retentativas de POST com o header Idempotency-Key.
+    
+    A primeira execução é registrada no estado compartilhado e as repetições,
+    em qualquer worker, recebem a mesma resposta byte a byte. Duplicatas
+    concorrentes aguardam a execução em andamento.
+    """
+    
+    def __init__(self, app, ttl: float = IDEMPOTENCIA_TTL_SEGUNDOS, max_entradas: int = IDEMPOTENCIA_MAX_ENTRADAS):
+        self.app = app
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        # Execuções deste worker: duplicatas locais esperam sem consultar o banco
+        self._em_andamento: Dict[tuple, asyncio.Future] = {}
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            return await self.app(scope, receive, send)
+        
+        chave_header = obter_header(scope, b"idempotency-key")
+        if not chave_header:
+            return await self.app(scope, receive, send)
+        if len(chave_header) > 255:
+            return await enviar_json(send, 400, {"detail": "Idempotency-Key deve ter no máximo 255 caracteres"})
+        
+        corpo = await self._ler_corpo(receive)
+        impressao = hashlib.sha256(corpo).digest()
+        chave = (chave_header, scope["path"])
+        
+        while True:
+            em_andamento = self._em_andamento.get(chave)
+            if em_andamento is not None:
+                await asyncio.shield(em_andamento)
+                continue
+            
+            agora = time.time()
+            salva = estado_db.reservar_idempotencia(*chave, impressao, agora, agora + IDEMPOTENCIA_RESERVA_SEGUNDOS)
+            if salva is None:
+                break
+            impressao_salva, status, headers, corpo_resposta = salva
+            if impressao_salva != impressao:
+                return await enviar_json(send, 422, {"detail": "Idempotency-Key já utilizada com outro corpo de requisição"})
+            if status is None:
+                # Em execução em outro worker
+                await asyncio.sleep(IDEMPOTENCIA_ESPERA_SEGUNDOS)
+                continue
+            await send({
+                "type": "http.response.start",
+                "status": status,
+                "headers": headers + [(b"idempotent-replayed", b"true")]
+            })
+            await send({"type": "http.response.body", "body": corpo_resposta})
+            return
+        
+        futuro = asyncio.get_running_loop().create_future()
+        self._em_andamento[chave] = futuro
+        inicio_resposta: dict = {}
+        partes: List[bytes] = []
+        corpo_pendente = [corpo]
+        
+        async def receive_com_corpo():
+            if corpo_pendente:
+                return {"type": "http.request", "body": corpo_pendente.pop(), "more_body": False}
+            return await receive()
+        
+        async def send_capturando(mensagem):
+            if mensagem["type"] == "http.response.start":
+                inicio_resposta.update(mensagem)
+            elif mensagem["type"] == "http.response.body":
+                partes.append(mensagem.get("body", b""))
+            await send(mensagem)
+        
+        guardada = False
+        try:
+            await self.app(scope, receive_com_corpo, send_capturando)
+            # Erros 5xx e 429 (admissão) não são guardados para que a retentativa possa ter sucesso
+            if inicio_resposta and inicio_resposta["status"] < 500 and inicio_resposta["status"] != 429:
+                agora = time.time()
+                estado_db.guardar_idempotencia(
+                    *chave, agora + self.ttl,
+                    inicio_resposta["status"],
+                    list(inicio_resposta.get("headers", [])),
+                    b"".join(partes),
+                    agora, self.max_entradas
+                )
+                guardada = True
+        finally:
+            if not guardada:
+                estado_db.liberar_idempotencia(*chave)
+            del self._em_andamento[chave]
+            futuro.set_result(None)
+    
+    @staticmethod
+    async def _ler_corpo(receive) -> bytes:
+        partes = []
+        while True:
+            mensagem = await receive()
+            partes.append(mensagem.get("body", b""))
+            if not mensagem.get("more_body"):
+                return b"".join(partes)
+    
+
+# Registrado depois (por fora) da admissão: retentativas já respondidas são
+# servidas do cache sem consumir tokens nem vaga no limite de concorrência
+app.add_middleware(IdempotenciaMiddleware)
+
+
+# --- Diário de requisições ---
+# Diretório dos segmentos (vazio desativa o diário)
+DIARIO_DIR = os.getenv(
+    "JOHN_DIARIO_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "diario")
+)
+DIARIO_BUFFER_MAX = int(os.getenv("JOHN_DIARIO_BUFFER_MAX", "50000"))
+DIARIO_BUFFER_MAX_BYTES = int(os.getenv("JOHN_DIARIO_BUFFER_MB", "64")) * 1024 * 1024
+# Segmentos fechados mais antigos são apagados acima deste total (0 = sem limite)
+DIARIO_RETENCAO_BYTES = int(os.getenv("JOHN_DIARIO_RETENCAO_MB", "1024")) * 1024 * 1024
+DIARIO_SEGMENTO_MAX_BYTES = int(os.getenv("JOHN_DIARIO_SEGMENTO_MB", "64")) * 1024 * 1024
+DIARIO_INTERVALO_SEGUNDOS = 1.0
+DIARIO_CORPO_MAX_BYTES = 256 * 1024
+DIARIO_HEADERS = (b"content-type", b"idempotency-key", b"user-agent", b"x-forwarded-for")
+
+class DiarioRequisicoes:
+    """
+    Diário append-only dos POSTs em segmentos JSONL rotativos.
+    
+    O handler apenas insere o registro num buffer circular em memória; uma
+    thread grava em disco, rotaciona por tamanho, comprime (gzip) os
+    segmentos fechados e apaga os mais antigos acima da retenção. Com o
+    buffer cheio (em registros ou bytes), os registros mais antigos são
+    descartados e contabilizados em `descartados`.
+    """
+    
+    def __init__(self, diretorio: str):
+        self.diretorio = diretorio
+        self.descartados = 0
+        # (registro, bytes de corpo + resposta); compartilhado com a thread de gravação
+        self._buffer: deque = deque()
+        self._bytes = 0
+        self._trava = threading.Lock()
+        self._acordar = threading.Event()
+        self._parar = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._arquivo = None
+        self._caminho: Optional[str] = None
+    
+    def registrar(self, registro: dict):
+        """Chamado no caminho da requisição: nunca toca o disco"""
+        tamanho = len(registro["corpo"]) + len(registro["resposta"])
+        with self._trava:
+            self._buffer.append((registro, tamanho))
+            self._bytes += tamanho
+            while len(self._buffer) > DIARIO_BUFFER_MAX or self._bytes > DIARIO_BUFFER_MAX_BYTES:
+                self._bytes -= self._buffer.popleft()[1]
+                self.descartados += 1
+    
+    def _proximo(self) -> Optional[dict]:
+        with self._trava:
+            if not self._buffer:
+                return None
+            registro, tamanho = self._buffer.popleft()
+            self._bytes -= tamanho
+            return registro
+    
+    def iniciar(self):
+        os.makedirs(self.diretorio, exist_ok=True)
+        self._parar.clear()
+        self._thread = threading.Thread(target=self._executar, name="diario-requisicoes", daemon=True)
+        self._thread.start()
+    
+    def encerrar(self):
+        if self._thread is None:
+            return
+        self._parar.set()
+        self._acordar.set()
+        self._thread.join()
+        self._thread = None
+    
+    def _executar(self):
+        while not self._parar.is_set():
+            self._acordar.wait(DIARIO_INTERVALO_SEGUNDOS)
+            self._acordar.clear()
+            self._gravar_pendentes()
+        self._gravar_pendentes()
+        self._fechar_segmento()
+    
+    def _gravar_pendentes(self):
+        if not self._buffer:
+            return
+        if self._arquivo is None:
+            self._abrir_segmento()
+        
+        while True:
+            registro = self._proximo()
+            if registro is None:
+                break
+            linha = json.dumps(self._serializar(registro), ensure_ascii=False)
+            self._arquivo.write(linha.encode("utf-8") + b"\n")
+            if self._arquivo.tell() >= DIARIO_SEGMENTO_MAX_BYTES:
+                self._fechar_segmento()
+                self._abrir_segmento()
+        self._arquivo.flush()
+    
+    def _abrir_segmento(self):
+        nome = f"diario-{datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{os.getpid()}.jsonl"
+        self._caminho = os.path.join(self.diretorio, nome)
+        self._arquivo = open(self._caminho, "ab")
+    
+    def _fechar_segmento(self):
+        """Fecha o segmento atual e o substitui pela versão comprimida"""
+        if self._arquivo is None:
+            return
+        self._arquivo.close()
+        self._arquivo = None
+        with open(self._caminho, "rb") as origem, gzip.open(f"{self._caminho}.gz", "wb") as destino:
+            shutil.copyfileobj(origem, destino)
+        os.remove(self._caminho)
+        self._aplicar_retencao()
+    
+    def _aplicar_retencao(self):
+        """Apaga os segmentos fechados mais antigos (de qualquer worker) acima da retenção"""
+        if not DIARIO_RETENCAO_BYTES:
+            return
+        segmentos = []
+        for nome in os.listdir(self.diretorio):
+            if nome.startswith("diario-") and nome.endswith(".jsonl.gz"):
+                try:
+                    segmentos.append((nome, os.path.getsize(os.path.join(self.diretorio, nome))))
+                except FileNotFoundError:
+                    continue
+        # O nome começa pelo horário de abertura: ordem alfabética = cronológica
+        segmentos.sort()
+        total = sum(tamanho for _, tamanho in segmentos)
+        for nome, tamanho in segmentos:
+            if total <= DIARIO_RETENCAO_BYTES:
+                break
+            try:
+                os.remove(os.path.join(self.diretorio, nome))
+            except FileNotFoundError:
+                pass
+            total -= tamanho
+    
+    @staticmethod
+    def _serializar(registro: dict) -> dict:
+        """Converte corpos em texto (ou base64 quando não são UTF-8)"""
+        for campo in ("corpo", "resposta"):
+            dados = registro.pop(campo)
+            try:
+                registro[campo] = dados.decode("utf-8")
+            except UnicodeDecodeError:
+                registro[campo] = base64.b64encode(dados).decode("ascii")
+                registro[f"{campo}_base64"] = True
+        return registro
+
+class CapturaCorpo:
+    """Acumula um corpo até DIARIO_CORPO_MAX_BYTES; o excedente é descartado na captura"""
+    
+    __slots__ = ("partes", "tamanho", "truncado")
+    
+    def __init__(self):
+        self.partes: List[bytes] = []
+        self.tamanho = 0
+        self.truncado = False
+    
+    def adicionar(self, dados: bytes):
+        restante = DIARIO_CORPO_MAX_BYTES - self.tamanho
+        if len(dados) > restante:
+            dados = dados[:restante]
+            self.truncado = True
+        if dados:
+            self.partes.append(dados)
+            self.tamanho += len(dados)
+    
+    def valor(self) -> bytes:
+        return b"".join(self.partes)
+
+class DiarioMiddleware:
+    """Registra requisição e resposta de cada POST no diário"""
+    
+    def __init__(self, app, diario: "DiarioRequisicoes"):
+        self.app = app
+        self.diario = diario
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            return await self.app(scope, receive, send)
+        
+        corpo = CapturaCorpo()
+        resposta = CapturaCorpo()
+        status = [0]
+        inicio = time.time()
+        
+        async def receive_registrando():
+            mensagem = await receive()
+            if mensagem["type"] == "http.request":
+                corpo.adicionar(mensagem.get("body", b""))
+            return mensagem
+        
+        async def send_registrando(mensagem):
+            if mensagem["type"] == "http.response.start":
+                status[0] = mensagem["status"]
+            elif mensagem["type"] == "http.response.body":
+                resposta.adicionar(mensagem.get("body", b""))
+            await send(mensagem)
+        
+        try:
+            await self.app(scope, receive_registrando, send_registrando)
+        finally:
+            fim = time.time()
+            # Gravado na conclusão: "ts_fim" é a ordem do segmento, "ts" a chegada
+            self.diario.registrar({
+                "ts": inicio,
+                "ts_fim": fim,
+                "metodo": scope["method"],
+                "caminho": scope["path"],
+                "query": scope.get("query_string", b"").decode("latin-1"),
+                "headers": {
+                    nome.decode("latin-1"): valor.decode("latin-1")
+                    for nome, valor in scope["headers"] if nome in DIARIO_HEADERS
+                },
+                "corpo": corpo.valor(),
+                "corpo_truncado": corpo.truncado,
+                "status": status[0],
+                "resposta": resposta.valor(),
+                "resposta_truncado": resposta.truncado,
+                "duracao_ms": round((fim - inicio) * 1000, 2)
+            })
+
+diario_requisicoes = DiarioRequisicoes(DIARIO_DIR)
+
+if DIARIO_DIR:
+    app.add_middleware(DiarioMiddleware, diario=diario_requisicoes)
+
+    @app.on_event("startup")
+    def iniciar_diario():
+        """Inicia a thread de gravação do diário (por worker)"""
+        diario_requisicoes.iniciar()
+
+    @app.on_event("shutdown")
+    def encerrar_diario():
+        """Grava os registros pendentes e fecha o segmento atual"""
+        diario_requisicoes.encerrar()
+
+
+# --- Compressão ---
+COMPRESSAO_MIN_BYTES = int(os.getenv("JOHN_COMPRESSAO_MIN_BYTES", "500"))
+COMPRESSAO_CACHE_MAX = int(os.getenv("JOHN_COMPRESSAO_CACHE_MAX", "256"))
+
+COMPRESSAO_TIPOS = ("application/json", "application/x-ndjson", "application/javascript", "application/xml", "text/")
+COMPRESSAO_TIPOS_STREAMING = ("application/x-ndjson", "text/event-stream")
+
+# Respostas com corpo imutável (independente da entrada do cliente): comprimidas
+# uma vez, no nível máximo, e servidas do cache. Caminho exato: só as listagens,
+# que são poucas; detalhes e seções de normas (muitas) seguem o caminho dinâmico
+COMPRESSAO_ROTAS_IMUTAVEIS = frozenset({
+    ("GET", "/templates"),
+    ("GET", "/familias"),
+    ("GET", "/dynamo/scripts"),
+    ("GET", "/normas"),
+})
+
+# Nível (dinâmico, imutável) por codificação
+COMPRESSAO_NIVEIS = {"br": (4, 11), "gzip": (6, 9)}
+
+# Acima deste tamanho o nível máximo custaria segundos de CPU: corpos imutáveis
+# grandes usam o nível dinâmico (e continuam em cache)
+COMPRESSAO_NIVEL_MAX_BYTES = 1024 * 1024
+
+def escolher_codificacao(accept_encoding: str) -> Optional[str]:
+    """Negocia a codificação pelo Accept-Encoding (brotli tem preferência no empate)"""
+    qualidades: Dict[str, float] = {}
+    for parte in accept_encoding.split(","):
+        nome, _, parametros = parte.partition(";")
+        qualidade = 1.0
+        parametros = parametros.strip()
+        if parametros.startswith("q="):
+            try:
+                qualidade = float(parametros[2:])
+            except ValueError:
+                qualidade = 0.0
+        if nome.strip():
+            qualidades[nome.strip().lower()] = qualidade
+
+    melhor, melhor_qualidade = None, 0.0
+    for codificacao in (("br",) if brotli else ()) + ("gzip",):
+        qualidade = qualidades.get(codificacao, qualidades.get("*", 0.0))
+        if qualidade > melhor_qualidade:
+            melhor, melhor_qualidade = codificacao, qualidade
+    return melhor
+
+def comprimir(dados: bytes, codificacao: str, nivel: int) -> bytes:
+    """Compressão completa de um corpo"""
+    if codificacao == "br":
+        return brotli.compress(dados, quality=nivel)
+    return gzip.compress(dados, compresslevel=nivel, mtime=0)
+
+class CompressorFluxo:
+    """Compressão incremental: cada parte é enviada assim que comprimida"""
+    
+    def __init__(self, codificacao: str):
+        self.codificacao = codificacao
+        nivel = COMPRESSAO_NIVEIS[codificacao][0]
+        if codificacao == "br":
+            self._compressor = brotli.Compressor(quality=nivel)
+        else:
+            self._compressor = zlib.compressobj(nivel, zlib.DEFLATED, 31)
+    
+    def comprimir(self, dados: bytes) -> bytes:
+        if self.codificacao == "br":
+            return self._compressor.process(dados) + self._compressor.flush()
+        return self._compressor.compress(dados) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+    
+    def finalizar(self) -> bytes:
+        if self.codificacao == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+class CompressaoMiddleware:
+    """
+    Compressão gzip/brotli negociada com o cliente.
+    
+    Corpos abaixo do tamanho mínimo seguem sem compressão; NDJSON e SSE são
+    comprimidos parte a parte; respostas de rotas imutáveis ficam em cache
+    já comprimidas, indexadas pelo hash do corpo.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+        self._cache: "OrderedDict[tuple, bytes]" = OrderedDict()
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        
+        codificacao = escolher_codificacao((obter_header(scope, b"accept-encoding") or b"").decode("latin-1"))
+        if codificacao is None:
+            return await self.app(scope, receive, send)
+        
+        imutavel = (scope["method"], scope["path"]) in COMPRESSAO_ROTAS_IMUTAVEIS
+        estado = {"modo": None, "inicio": None, "fluxo": None}
+        partes: List[bytes] = []
+        
+        async def send_comprimindo(mensagem):
+            if mensagem["type"] == "http.response.start":
+                estado["inicio"] = mensagem
+                return
+            if mensagem["type"] != "http.response.body" or estado["modo"] == "direto":
+                return await send(mensagem)
+            
+            if estado["modo"] is None:
+                headers = MutableHeaders(raw=list(estado["inicio"]["headers"]))
+                tipo = headers.get("content-type", "")
+                if "content-encoding" in headers or not tipo.startswith(COMPRESSAO_TIPOS):
+                    estado["modo"] = "direto"
+                    await send(estado["inicio"])
+                    return await send(mensagem)
+                headers.add_vary_header("Accept-Encoding")
+                if tipo.startswith(COMPRESSAO_TIPOS_STREAMING):
+                    estado["modo"] = "fluxo"
+                    estado["fluxo"] = CompressorFluxo(codificacao)
+                    headers["content-encoding"] = codificacao
+                    del headers["content-length"]
+                else:
+                    estado["modo"] = "buffer"
+                estado["inicio"] = dict(estado["inicio"], headers=headers.raw)
+                if estado["modo"] == "fluxo":
+                    await send(estado["inicio"])
+            
+            corpo = mensagem.get("body", b"")
+            mais = mensagem.get("more_body", False)
+            
+            if estado["modo"] == "fluxo":
+                comprimido = estado["fluxo"].comprimir(corpo) if corpo else b""
+                if not mais:
+                    comprimido += estado["fluxo"].finalizar()
+                return await send({"type": "http.response.body", "body": comprimido, "more_body": mais})
+            
+            partes.append(corpo)
+            if mais:
+                return
+            corpo = b"".join(partes)
+            inicio = estado["inicio"]
+            if len(corpo) >= COMPRESSAO_MIN_BYTES:
+                corpo = await self._comprimir(corpo, codificacao, imutavel)
+                headers = MutableHeaders(raw=inicio["headers"])
+                headers["content-encoding"] = codificacao
+                headers["content-length"] = str(len(corpo))
+            await send(inicio)
+            await send({"type": "http.response.body", "body": corpo})
+        
+        await self.app(scope, receive, send_comprimindo)
+    
+    async def _comprimir(self, corpo: bytes, codificacao: str, imutavel: bool) -> bytes:
+        if not imutavel:
+            return comprimir(corpo, codificacao, COMPRESSAO_NIVEIS[codificacao][0])
+        
+        chave = (codificacao, hashlib.blake2b(corpo, digest_size=16).digest())
+        comprimido = self._cache.get(chave)
+        if comprimido is None:
+            # Nível máximo fora do event loop (brotli e zlib liberam o GIL)
+            nivel = COMPRESSAO_NIVEIS[codificacao][len(corpo) <= COMPRESSAO_NIVEL_MAX_BYTES]
+            comprimido = await asyncio.to_thread(comprimir, corpo, codificacao, nivel)
+            self._cache[chave] = comprimido
+            if len(self._cache) > COMPRESSAO_CACHE_MAX:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(chave)
+        return comprimido
+
+app.add_middleware(CompressaoMiddleware)
+
+
 # ============================================
 # ENDPOINTS - HEALTH
 # ============================================
@@ -414,7 +1998,7 @@ async def verificar_saude():
         "version": "2.0.0",
         "timestamp": datetime.now().isoformat(),
         "service": "JOHN | Revit BIM Manager API",
-        "endpoints_ativos": 18
+        "endpoints_ativos": 23
     }
 
 
@@ -427,9 +2011,7 @@ async def listar_templates(
     tipo_projeto: Optional[str] = Query(None, description="Filtrar por tipo de projeto")
 ):
     """Listar templates disponíveis"""
-    if tipo_projeto:
-        return [t for t in templates_db if t["tipo_projeto"] == tipo_projeto]
-    return templates_db
+    return filtrar_catalogo(templates_db, tipo_projeto=tipo_projeto)
 
 
 @app.post("/templates", tags=["Templates"])
@@ -455,14 +2037,14 @@ async def criar_template(request: TemplateRequest):
         }
     }
     
-    salvar_requisicao(id_req, "template", resultado)
+    salvar_requisicao(id_req, "template", resultado, request.callback_url)
     return resultado
 
 
 @app.get("/templates/{template_id}/download", tags=["Templates"])
 async def download_template(template_id: str = Path(..., description="ID do template")):
     """Download do arquivo template"""
-    template = next((t for t in templates_db if t["id"] == template_id), None)
+    template = buscar_no_catalogo(templates_db, "id", template_id)
     
     if not template:
         raise HTTPException(status_code=404, detail="Template não encontrado")
@@ -485,9 +2067,7 @@ async def listar_familias(
     categoria: Optional[str] = Query(None, description="Filtrar por categoria")
 ):
     """Listar famílias disponíveis"""
-    if categoria:
-        return [f for f in familias_db if f["categoria"] == categoria]
-    return familias_db
+    return filtrar_catalogo(familias_db, categoria=categoria)
 
 
 @app.post("/familias", tags=["Famílias"])
@@ -512,14 +2092,14 @@ async def criar_familia(request: FamiliaRequest):
         }
     }
     
-    salvar_requisicao(id_req, "familia", resultado)
+    salvar_requisicao(id_req, "familia", resultado, request.callback_url)
     return resultado
 
 
 @app.get("/familias/{familia_id}/download", tags=["Famílias"])
 async def download_familia(familia_id: str = Path(..., description="ID da família")):
     """Download do arquivo família"""
-    familia = next((f for f in familias_db if f["id"] == familia_id), None)
+    familia = buscar_no_catalogo(familias_db, "id", familia_id)
     
     if not familia:
         raise HTTPException(status_code=404, detail="Família não encontrada")
@@ -542,9 +2122,7 @@ async def listar_scripts_dynamo(
     categoria: Optional[str] = Query(None, description="Filtrar por categoria")
 ):
     """Listar scripts Dynamo disponíveis"""
-    if categoria:
-        return [s for s in scripts_db if s["categoria"] == categoria]
-    return scripts_db
+    return filtrar_catalogo(scripts_db, categoria=categoria)
 
 
 @app.post("/dynamo/scripts", tags=["Dynamo"])
@@ -584,7 +2162,7 @@ USA PYTHON: {"Sim" if request.usar_python else "Não"}
         }
     }
     
-    salvar_requisicao(id_req, "dynamo", resultado)
+    salvar_requisicao(id_req, "dynamo", resultado, request.callback_url)
     return resultado
 
 
@@ -633,72 +2211,37 @@ async def auditar_modelo(request: AuditoriaRequest):
         "url_relatorio_pdf": f"https://api.aexconstrutiva.com.br/download/{id_req}/auditoria_relatorio.pdf"
     }
     
-    salvar_requisicao(id_req, "auditoria", resultado)
+    salvar_requisicao(id_req, "auditoria", resultado, request.callback_url)
     return resultado
 
 
 @app.post("/auditoria/checklist", tags=["Auditoria"])
 async def gerar_checklist(request: ChecklistRequest):
     """Gerar checklist de auditoria BIM"""
+    fase = normalizar_chave(request.fase)
+    if fase not in CHECKLIST_FASES:
+        raise HTTPException(status_code=400, detail=f"Fase inválida. Use: {', '.join(CHECKLIST_FASES)}")
     
-    # Checklists por fase
-    itens_por_fase = {
-        "concepcao": [
-            "Volume geral do edifício definido",
-            "Níveis principais criados",
-            "Grid estrutural básico",
-            "Estudo de massas concluído"
-        ],
-        "anteprojeto": [
-            "Paredes externas modeladas",
-            "Esquadrias principais posicionadas",
-            "Circulações verticais definidas",
-            "Cobertura modelada"
-        ],
-        "projeto_legal": [
-            "Áreas calculadas e verificadas",
-            "Cotas de nível conferidas",
-            "Acessibilidade verificada (NBR 9050)",
-            "Recuos e afastamentos conferidos"
-        ],
-        "executivo": [
-            "Detalhamento completo",
-            "Quantitativos extraídos",
-            "Compatibilização realizada",
-            "Pranchas geradas"
-        ],
-        "as_built": [
-            "Modelo atualizado conforme construído",
-            "Informações de fabricantes incluídas",
-            "Documentação de manutenção anexada",
-            "Entrega para operação preparada"
-        ]
-    }
-    
-    itens = itens_por_fase.get(request.fase, [])
+    # O curinga só existe nas regras; vindo da requisição duplicaria os fragmentos gerais
+    disciplinas = tuple(sorted({normalizar_chave(d) for d in request.disciplinas or []} - {QUALQUER}))
+    tipo_projeto = normalizar_chave(request.tipo_projeto)
+    itens = compor_checklist("" if tipo_projeto == QUALQUER else tipo_projeto, fase, disciplinas)
     
     checklist = {
         "titulo": f"Checklist BIM - {request.tipo_projeto.title()} - Fase {request.fase.replace('_', ' ').title()}",
         "tipo_projeto": request.tipo_projeto,
         "fase": request.fase,
         "disciplinas": request.disciplinas or ["geral"],
+        # Dicts novos a cada requisição: o cache guarda apenas tuplas
         "itens": [
             {
-                "categoria": "Verificações Gerais",
+                "categoria": categoria,
                 "verificacoes": [
-                    {"item": item, "obrigatorio": True, "status": "pendente"}
-                    for item in itens
-                ]
-            },
-            {
-                "categoria": "Qualidade do Modelo",
-                "verificacoes": [
-                    {"item": "Warnings abaixo de 100", "obrigatorio": True, "status": "pendente"},
-                    {"item": "Purge Unused executado", "obrigatorio": True, "status": "pendente"},
-                    {"item": "Audit realizado", "obrigatorio": False, "status": "pendente"},
-                    {"item": "Nomenclatura padronizada", "obrigatorio": True, "status": "pendente"}
+                    {"item": item, "obrigatorio": obrigatorio, "status": "pendente"}
+                    for item, obrigatorio in verificacoes
                 ]
             }
+            for categoria, verificacoes in itens
         ],
         "gerado_em": datetime.now().isoformat()
     }
@@ -752,7 +2295,7 @@ async def extrair_quantitativos(request: QuantitativosRequest):
         "url_download_excel": f"https://api.aexconstrutiva.com.br/download/{id_req}/quantitativos.xlsx"
     }
     
-    salvar_requisicao(id_req, "quantitativos", resultado)
+    salvar_requisicao(id_req, "quantitativos", resultado, request.callback_url)
     return resultado
 
 
@@ -794,7 +2337,7 @@ async def validar_ifc(request: IFCValidacaoRequest):
         ]
     }
     
-    salvar_requisicao(id_req, "ifc", resultado)
+    salvar_requisicao(id_req, "ifc", resultado, request.callback_url)
     return resultado
 
 
@@ -808,20 +2351,13 @@ async def listar_normas(
     area: Optional[str] = Query(None, description="Área de aplicação")
 ):
     """Listar normas técnicas disponíveis"""
-    resultado = normas_db
-    
-    if tipo:
-        resultado = [n for n in resultado if n["tipo"] == tipo]
-    if area:
-        resultado = [n for n in resultado if n["area"] == area]
-    
-    return resultado
+    return filtrar_catalogo(normas_db, tipo=tipo, area=area)
 
 
 @app.get("/normas/{codigo}", tags=["Normas"])
 async def consultar_norma(codigo: str = Path(..., description="Código da norma")):
     """Consultar norma específica"""
-    norma = next((n for n in normas_db if n["codigo"] == codigo), None)
+    norma = buscar_no_catalogo(normas_db, "codigo", codigo)
     
     if not norma:
         raise HTTPException(status_code=404, detail="Norma não encontrada")
@@ -829,6 +2365,65 @@ async def consultar_norma(codigo: str = Path(..., description="Código da norma"
     return norma
 
 
+def _documento_da_norma(codigo: str) -> DocumentoNorma:
+    """Documento de uma norma do catálogo (o código nunca vira caminho sem passar pelo catálogo)"""
+    norma = buscar_no_catalogo(normas_db, "codigo", codigo)
+    if not norma:
+        raise HTTPException(status_code=404, detail="Norma não encontrada")
+
+    documento = obter_documento_norma(norma["codigo"])
+    if documento is None:
+        raise HTTPException(status_code=404, detail="Texto da norma não disponível")
+    return documento
+
+
+@app.get("/normas/{codigo}/secoes", tags=["Normas"])
+async def listar_secoes_norma(
+    codigo: str = Path(..., description="Código da norma"),
+    pagina: int = Query(1, ge=1, description="Página"),
+    por_pagina: int = Query(50, ge=1, le=500, description="Seções por página")
+):
+    """Listar seções da norma (sumário paginado, sem o texto)"""
+    documento = _documento_da_norma(codigo)
+    inicio = (pagina - 1) * por_pagina
+
+    return {
+        "codigo": codigo,
+        "total": len(documento.secoes),
+        "pagina": pagina,
+        "por_pagina": por_pagina,
+        "secoes": [
+            {"secao": secao, "titulo": titulo, "nivel": secao.count(".") + 1, "tamanho_bytes": fim - inicio_texto}
+            for secao, titulo, inicio_texto, fim in documento.secoes[inicio:inicio + por_pagina]
+        ]
+    }
+
+
+@app.get("/normas/{codigo}/secoes/{secao}", tags=["Normas"])
+async def consultar_secao_norma(
+    codigo: str = Path(..., description="Código da norma"),
+    secao: str = Path(..., description="Número da seção (ex: 4.2)")
+):
+    """Consultar o texto de uma seção da norma"""
+    documento = _documento_da_norma(codigo)
+    posicao = documento.posicao(secao)
+
+    if posicao is None:
+        raise HTTPException(status_code=404, detail="Seção não encontrada")
+
+    anterior = documento.secoes[posicao - 1][0] if posicao > 0 else None
+    proxima = documento.secoes[posicao + 1][0] if posicao + 1 < len(documento.secoes) else None
+
+    return {
+        "codigo": codigo,
+        "secao": secao,
+        "titulo": documento.secoes[posicao][1],
+        "texto": documento.texto(posicao),
+        "secao_anterior": anterior,
+        "proxima_secao": proxima
+    }
+
+
 # ============================================
 # ENDPOINTS - RELATÓRIOS
 # ============================================
@@ -836,45 +2431,97 @@ async def consultar_norma(codigo: str = Path(..., description="Código da norma"
 @app.post("/relatorios/bep", tags=["Relatórios"])
 async def gerar_bep(request: BEPRequest):
     """Gerar BIM Execution Plan"""
+    formato = (request.formato or "pdf").lower()
+    if formato not in BEP_FORMATOS:
+        raise HTTPException(status_code=400, detail=f"Formato inválido. Use: {', '.join(BEP_FORMATOS)}")
+
     id_req = gerar_id_requisicao()
+    disciplinas = request.disciplinas or BEP_DISCIPLINAS_PADRAO
+    arquivo_bep = f"bep.{formato}"
+
+    # Renderização no pool de processos para não bloquear o event loop
+    dados = {
+        "id_requisicao": id_req,
+        "nome_projeto": request.nome_projeto,
+        "tipo_projeto": request.tipo_projeto,
+        "cliente": request.cliente or "-",
+        "disciplinas": disciplinas,
+        "data_emissao": datetime.now().strftime("%d/%m/%Y")
+    }
+    loop = asyncio.get_running_loop()
+    tamanho = await loop.run_in_executor(
+        obter_pool_bep(), renderizar_bep, dados, formato, os.path.join(ARQUIVOS_DIR, id_req, arquivo_bep)
+    )
     
     resultado = {
         "status": "sucesso",
         "id_requisicao": id_req,
-        "arquivo": f"BEP_{request.nome_projeto.replace(' ', '_')}.pdf",
-        "url_download": f"https://api.aexconstrutiva.com.br/download/{id_req}/bep.pdf",
+        "arquivo": f"BEP_{request.nome_projeto.replace(' ', '_')}.{formato}",
+        "url_download": f"https://api.aexconstrutiva.com.br/download/{id_req}/{arquivo_bep}",
+        "tamanho_kb": round(tamanho / 1024, 1),
         "conteudo_gerado": {
             "nome_projeto": request.nome_projeto,
             "tipo_projeto": request.tipo_projeto,
             "cliente": request.cliente,
-            "disciplinas": request.disciplinas or ["Arquitetura", "Estrutura", "MEP"],
-            "secoes_incluidas": [
-                "Informações do Projeto",
-                "Objetivos BIM",
-                "Usos do Modelo BIM",
-                "Matriz de Responsabilidades",
-                "Requisitos de Entrega",
-                "Padrões e Protocolos",
-                "Infraestrutura Tecnológica",
-                "Controle de Qualidade"
-            ]
+            "disciplinas": disciplinas,
+            "secoes_incluidas": [titulo for titulo, _, _ in BEP_SECOES]
         }
     }
     
-    salvar_requisicao(id_req, "bep", resultado)
+    salvar_requisicao(id_req, "bep", resultado, request.callback_url)
     return resultado
 
 
+# ============================================
+# ENDPOINTS - DOWNLOAD
+# ============================================
+
+@app.get("/download/{id_requisicao}/{arquivo}", tags=["Download"])
+async def baixar_arquivo(
+    id_requisicao: str = Path(..., description="ID da requisição"),
+    arquivo: str = Path(..., description="Nome do arquivo gerado")
+):
+    """Download de arquivo gerado por uma requisição"""
+    raiz = os.path.realpath(ARQUIVOS_DIR)
+    caminho = os.path.realpath(os.path.join(raiz, id_requisicao, arquivo))
+    
+    if not caminho.startswith(raiz + os.sep) or not os.path.isfile(caminho):
+        raise HTTPException(status_code=404, detail="Arquivo não encontrado")
+    
+    return FileResponse(caminho, filename=arquivo)
+
+
 # ============================================
 # ENDPOINTS - STATUS
 # ============================================
 
+@app.get("/webhooks/falhas", tags=["Status"])
+async def listar_falhas_webhooks():
+    """Listar callbacks que esgotaram as tentativas de entrega"""
+    return fila_webhooks.falhas
+
+
+@app.get("/requisicoes", tags=["Status"])
+async def listar_requisicoes(
+    desde: Optional[datetime] = Query(None, description="Início do intervalo (ISO 8601)"),
+    ate: Optional[datetime] = Query(None, description="Fim do intervalo (ISO 8601)"),
+    tipo: Optional[str] = Query(None, description="Tipo da requisição (template, familia, bep...)"),
+    limit: int = Query(100, ge=1, le=1000, description="Máximo de requisições retornadas")
+):
+    """Listar requisições por intervalo de tempo, em ordem de criação"""
+    desde_ms = int(desde.timestamp() * 1000) if desde else 0
+    ate_ms = int(ate.timestamp() * 1000) if ate else int(time.time() * 1000)
+    
+    return Response(consultar_requisicoes(desde_ms, ate_ms, tipo, limit), media_type="application/json")
+
+
 @app.get("/status/{id_requisicao}", tags=["Status"])
 async def obter_status(id_requisicao: str = Path(..., description="ID da requisição")):
     """Verificar status de uma requisição"""
     
-    if id_requisicao in requisicoes_db:
-        return requisicoes_db[id_requisicao]
+    registro = estado_db.obter_requisicao(id_requisicao)
+    if registro is not None:
+        return Response(registro, media_type="application/json")
     
     raise HTTPException(status_code=404, detail="Requisição não encontrada")
 
@@ -0,0 +1,171 @@
+"""
+JOHN | Revit BIM Manager - Reprodução do diário de requisições
+
+Reenvia os POSTs gravados no diário (segmentos .jsonl e .jsonl.gz) respeitando
+os intervalos originais entre requisições, acelerados pelo fator de velocidade.
+Por padrão executa contra o app em processo; com --url, contra um servidor.
+
+Os registros são gravados na conclusão, então os segmentos são mesclados pela
+ordem de conclusão ("ts_fim"); o ritmo segue a chegada ("ts"). Requisições que
+se sobrepuseram no original podem ser reenviadas em ordem ligeiramente diferente.
+
+USO:
+    python reproduzir_diario.py diario/
+    python reproduzir_diario.py diario/ --velocidade 4
+    python reproduzir_diario.py diario/diario-20260101T000000000000-123.jsonl.gz --velocidade 0
+    python reproduzir_diario.py diario/ --url http://localhost:8000 --concorrencia 200
+"""
+
+from collections import Counter
+from typing import Iterator, List
+import argparse
+import asyncio
+import base64
+import glob
+import gzip
+import heapq
+import json
+import os
+import time
+
+import httpx
+
+
+def listar_segmentos(caminhos: List[str]) -> List[str]:
+    """Expande diretórios nos segmentos que contêm"""
+    segmentos = []
+    for caminho in caminhos:
+        if os.path.isdir(caminho):
+            segmentos += glob.glob(os.path.join(caminho, "diario-*.jsonl"))
+            segmentos += glob.glob(os.path.join(caminho, "diario-*.jsonl.gz"))
+        else:
+            segmentos.append(caminho)
+    return sorted(segmentos)
+
+
+def ler_segmento(caminho: str) -> Iterator[dict]:
+    abrir = gzip.open if caminho.endswith(".gz") else open
+    with abrir(caminho, "rt", encoding="utf-8") as f:
+        for linha in f:
+            # Última linha de um segmento ainda aberto pode estar incompleta
+            try:
+                yield json.loads(linha)
+            except json.JSONDecodeError:
+                continue
+
+
+def ordem_gravacao(registro: dict) -> float:
+    # Segmentos antigos, sem "ts_fim", ficam na ordem aproximada de "ts"
+    return registro.get("ts_fim", registro["ts"])
+
+
+def ler_diario(caminhos: List[str]) -> Iterator[dict]:
+    """Registros de todos os segmentos (um por worker) em ordem de conclusão"""
+    return heapq.merge(*(ler_segmento(c) for c in listar_segmentos(caminhos)), key=ordem_gravacao)
+
+
+def corpo_original(registro: dict) -> bytes:
+    if registro.get("corpo_base64"):
+        return base64.b64decode(registro["corpo"])
+    return registro["corpo"].encode("utf-8")
+
+
+def percentil(valores: List[float], p: float) -> float:
+    if not valores:
+        return 0.0
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p))]
+
+
+async def reproduzir(args: argparse.Namespace):
+    if args.url:
+        cliente = httpx.AsyncClient(base_url=args.url, timeout=60)
+        app = None
+    else:
+        # Em processo: sem gravar a própria reprodução no diário e sem controle de
+        # admissão (todas as requisições chegariam do mesmo cliente e seriam limitadas)
+        os.environ["JOHN_DIARIO_DIR"] = ""
+        os.environ["JOHN_ADMISSAO_ATIVA"] = "0"
+        import main
+        app = main.app
+        cliente = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://reproducao", timeout=60)
+
+    limite = asyncio.Semaphore(args.concorrencia)
+    status = Counter()
+    divergentes = Counter()
+    truncados = Counter()
+    latencias: List[float] = []
+    tarefas = set()
+
+    async def enviar(registro: dict):
+        try:
+            inicio = time.monotonic()
+            try:
+                url = registro["caminho"] + (f"?{registro['query']}" if registro.get("query") else "")
+                resposta = await cliente.request(
+                    registro["metodo"], url, content=corpo_original(registro), headers=registro.get("headers", {})
+                )
+                codigo = resposta.status_code
+            except httpx.HTTPError as erro:
+                codigo = type(erro).__name__
+            latencias.append(time.monotonic() - inicio)
+            status[codigo] += 1
+            if codigo != registro.get("status"):
+                divergentes[f"{registro['caminho']}: {registro.get('status')} -> {codigo}"] += 1
+        finally:
+            limite.release()
+
+    async def executar():
+        inicio_reproducao = time.monotonic()
+        inicio_diario = None
+        for total, registro in enumerate(ler_diario(args.segmentos), 1):
+            if args.limite and total > args.limite:
+                break
+            # Corpo gravado incompleto: reenviá-lo seria uma requisição inválida
+            if registro.get("corpo_truncado"):
+                truncados[registro["caminho"]] += 1
+                continue
+            inicio_diario = registro["ts"] if inicio_diario is None else inicio_diario
+            if args.velocidade > 0:
+                atraso = (registro["ts"] - inicio_diario) / args.velocidade - (time.monotonic() - inicio_reproducao)
+                if atraso > 0:
+                    await asyncio.sleep(atraso)
+            # Vaga obtida antes de criar a tarefa: no máximo --concorrencia
+            # registros em memória, mesmo com --velocidade 0
+            await limite.acquire()
+            tarefa = asyncio.create_task(enviar(registro))
+            tarefas.add(tarefa)
+            tarefa.add_done_callback(tarefas.discard)
+        await asyncio.gather(*tarefas)
+        return time.monotonic() - inicio_reproducao
+
+    async with cliente:
+        if app is not None:
+            async with app.router.lifespan_context(app):
+                duracao = await executar()
+        else:
+            duracao = await executar()
+
+    total = sum(status.values())
+    print(f"[OK] {total} requisições reproduzidas em {duracao:.1f}s ({total / max(duracao, 1e-9):.1f} req/s)")
+    print(f"     Latência p50 {percentil(latencias, 0.5) * 1000:.1f} ms | p99 {percentil(latencias, 0.99) * 1000:.1f} ms")
+    print(f"     Status: {dict(status)}")
+    for descricao, quantidade in divergentes.most_common(10):
+        print(f"     Divergência {descricao} ({quantidade}x)")
+    for caminho, quantidade in truncados.most_common(10):
+        print(f"     Ignorado {caminho}: corpo truncado no diário ({quantidade}x)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reproduz o diário de requisições do JOHN API Server")
+    parser.add_argument("segmentos", nargs="+", help="Diretório do diário ou arquivos de segmento")
+    parser.add_argument("--velocidade", type=float, default=1.0,
+                        help="Fator sobre o ritmo original (2 = duas vezes mais rápido, 0 = sem espera)")
+    parser.add_argument("--url", help="Servidor alvo (padrão: app em processo)")
+    parser.add_argument("--concorrencia", type=int, default=100, help="Máximo de requisições simultâneas")
+    parser.add_argument("--limite", type=int, default=0, help="Reproduz apenas os N primeiros registros")
+    asyncio.run(reproduzir(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Testes importam main.py da raiz do projeto, sem gravar diário nem estado no projeto
+os.environ.setdefault("JOHN_DIARIO_DIR", "")
+os.environ.setdefault("JOHN_ESTADO_DB", os.path.join(tempfile.mkdtemp(prefix="john-testes-"), "estado.db"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(autouse=True)
+def estado_isolado(monkeypatch, tmp_path):
+    """Cada teste usa um banco de estado próprio"""
+    import main
+    from estado import EstadoCompartilhado
+
+    estado = EstadoCompartilhado(str(tmp_path / "estado.db"))
+    monkeypatch.setattr(main, "estado_db", estado)
+    yield estado
+    estado.fechar()
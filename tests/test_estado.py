@@ -0,0 +1,90 @@
+"""Estado compartilhado: requisições, Idempotency-Key entre workers e expiração"""
+
+import os
+import time
+
+from fastapi.testclient import TestClient
+
+import main
+from estado import EstadoCompartilhado
+
+TEMPLATE = {"nome": "T", "tipo_projeto": "residencial", "descricao": "x"}
+
+
+def test_requisicao_visivel_em_outro_worker(estado_isolado):
+    cliente = TestClient(main.app)
+    id_req = cliente.post("/templates", json=TEMPLATE).json()["id_requisicao"]
+
+    # Outro worker (ou um worker reciclado) abre o mesmo arquivo
+    outro = EstadoCompartilhado(estado_isolado.caminho)
+    assert '"tipo":"template"' in outro.obter_requisicao(id_req)
+    outro.fechar()
+
+    assert cliente.get(f"/status/{id_req}").json()["id_requisicao"] == id_req
+    assert cliente.get("/status/req-inexistente").status_code == 404
+
+
+def test_consulta_por_intervalo_e_tipo():
+    cliente = TestClient(main.app)
+    antes = int(time.time() * 1000)
+    ids = [cliente.post("/templates", json=TEMPLATE).json()["id_requisicao"] for _ in range(3)]
+    main.salvar_requisicao(main.gerar_id_requisicao(), "familia", {})
+
+    todas = cliente.get("/requisicoes").json()
+    assert [r["id_requisicao"] for r in todas][:3] == ids
+    assert len(cliente.get("/requisicoes", params={"tipo": "template"}).json()) == 3
+    assert len(cliente.get("/requisicoes", params={"limit": 2}).json()) == 2
+
+    main.expirar_requisicoes(antes + int(main.REQUISICOES_TTL_HORAS * 3600 * 1000) + 60_000)
+    assert cliente.get("/requisicoes").json() == []
+
+
+def test_expiracao_remove_arquivos_bep(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "ARQUIVOS_DIR", str(tmp_path))
+    id_req = main.gerar_id_requisicao()
+    os.makedirs(tmp_path / id_req)
+    main.salvar_requisicao(id_req, "bep", {})
+
+    assert main.expirar_requisicoes(int(time.time() * 1000)) == 0
+    assert main.expirar_requisicoes(int(time.time() * 1000) + int(main.REQUISICOES_TTL_HORAS * 3600 * 1000) + 1) == 1
+    assert not os.path.exists(tmp_path / id_req)
+
+
+def test_idempotencia_repete_resposta():
+    cliente = TestClient(main.app)
+    headers = {"Idempotency-Key": "chave-1"}
+    primeira = cliente.post("/templates", json=TEMPLATE, headers=headers)
+    segunda = cliente.post("/templates", json=TEMPLATE, headers=headers)
+
+    assert segunda.headers["idempotent-replayed"] == "true"
+    assert segunda.content == primeira.content
+    assert cliente.post("/templates", json={**TEMPLATE, "nome": "U"}, headers=headers).status_code == 422
+
+
+def test_reserva_idempotencia_entre_workers(estado_isolado):
+    outro = EstadoCompartilhado(estado_isolado.caminho)
+    agora = time.time()
+
+    assert estado_isolado.reservar_idempotencia("k", "/templates", b"a", agora, agora + 300) is None
+    # Em andamento no primeiro worker: o segundo espera
+    assert outro.reservar_idempotencia("k", "/templates", b"a", agora, agora + 300)[1] is None
+
+    estado_isolado.guardar_idempotencia("k", "/templates", agora + 3600, 201,
+                                        [(b"content-type", b"application/json")], b"{}", agora, 100)
+    assert outro.reservar_idempotencia("k", "/templates", b"a", agora, agora + 300) == (
+        b"a", 201, [(b"content-type", b"application/json")], b"{}"
+    )
+
+    # Reserva sem resposta guardada (erro) é liberada; vencida é reaproveitada
+    assert outro.reservar_idempotencia("x", "/templates", b"b", agora, agora + 300) is None
+    outro.liberar_idempotencia("x", "/templates")
+    assert estado_isolado.reservar_idempotencia("x", "/templates", b"b", agora, agora + 1) is None
+    assert outro.reservar_idempotencia("x", "/templates", b"c", agora + 2, agora + 300) is None
+    outro.fechar()
+
+
+def test_falhas_webhook_limitadas(estado_isolado):
+    for i in range(5):
+        estado_isolado.registrar_falha_webhook({"id_requisicao": f"req-{i}"}, maximo=3)
+
+    assert [f["id_requisicao"] for f in estado_isolado.falhas_webhook()] == ["req-2", "req-3", "req-4"]
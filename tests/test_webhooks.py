@@ -0,0 +1,177 @@
+"""Fila de webhooks: entrega, retentativa com backoff, dead letter e destinos bloqueados"""
+
+import asyncio
+import json
+
+import pytest
+from pydantic import ValidationError
+
+import main
+
+
+class Receptor:
+    """Receptor HTTP local que responde com os status programados (depois, 200)"""
+
+    def __init__(self, *status: int):
+        self.status = list(status)
+        self.recebidas = []
+        self._conexoes = []
+
+    async def __aenter__(self):
+        self._servidor = await asyncio.start_server(self._atender, "127.0.0.1", 0)
+        self.porta = self._servidor.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *_):
+        self._servidor.close()
+        for escritor in self._conexoes:
+            escritor.close()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.porta}/callback"
+
+    async def _atender(self, leitor, escritor):
+        self._conexoes.append(escritor)
+        while True:
+            try:
+                cabecalho = await leitor.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            linhas = cabecalho.decode("latin-1").split("\r\n")[1:]
+            headers = {k.lower(): v.strip() for k, _, v in (l.partition(":") for l in linhas if l)}
+            corpo = await leitor.readexactly(int(headers.get("content-length", 0)))
+            self.recebidas.append((headers, json.loads(corpo)))
+            status = self.status.pop(0) if self.status else 200
+            escritor.write(f"HTTP/1.1 {status} X\r\nContent-Length: 0\r\n\r\n".encode())
+            await escritor.drain()
+
+
+async def aguardar(condicao, timeout: float = 5.0):
+    limite = asyncio.get_running_loop().time() + timeout
+    while not condicao():
+        assert asyncio.get_running_loop().time() < limite, "tempo esgotado"
+        await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+def receptor_permitido(monkeypatch):
+    monkeypatch.setattr(main, "WEBHOOK_HOSTS_PERMITIDOS", frozenset({"127.0.0.1"}))
+    monkeypatch.setattr(main, "WEBHOOK_BACKOFF_SEGUNDOS", 0.01)
+
+
+def test_entrega_registro(receptor_permitido):
+    async def cenario():
+        fila = main.FilaWebhooks()
+        await fila.iniciar()
+        async with Receptor() as receptor:
+            fila.agendar(receptor.url, {"id_requisicao": "req-1", "status": "concluido"})
+            await aguardar(lambda: receptor.recebidas)
+            await fila.encerrar()
+
+        headers, corpo = receptor.recebidas[0]
+        assert corpo == {"id_requisicao": "req-1", "status": "concluido"}
+        assert headers["x-john-requisicao"] == "req-1"
+        assert headers["x-john-tentativa"] == "1"
+        assert not fila.falhas
+        assert fila._semaforos == {}
+
+    asyncio.run(cenario())
+
+
+def test_retentativa_com_backoff(receptor_permitido):
+    async def cenario():
+        fila = main.FilaWebhooks(max_tentativas=5)
+        await fila.iniciar()
+        async with Receptor(500, 503) as receptor:
+            fila.agendar(receptor.url, {"id_requisicao": "req-2"})
+            await aguardar(lambda: len(receptor.recebidas) == 3)
+            await fila.encerrar()
+
+        assert [h["x-john-tentativa"] for h, _ in receptor.recebidas] == ["1", "2", "3"]
+        assert not fila.falhas
+
+    asyncio.run(cenario())
+
+
+def test_dead_letter_apos_esgotar_tentativas(receptor_permitido):
+    async def cenario():
+        fila = main.FilaWebhooks(max_tentativas=3)
+        await fila.iniciar()
+        async with Receptor(500, 500, 500, 500) as receptor:
+            fila.agendar(receptor.url, {"id_requisicao": "req-3"})
+            await aguardar(lambda: fila.falhas)
+            await fila.encerrar()
+
+        assert len(receptor.recebidas) == 3
+        falha = fila.falhas[0]
+        assert falha["id_requisicao"] == "req-3"
+        assert falha["tentativas"] == 3
+        assert falha["erro"] == "HTTP 500"
+
+    asyncio.run(cenario())
+
+
+def test_destino_interno_descartado_sem_retentativa(monkeypatch):
+    # Sem lista de hosts permitidos: nome que resolve para loopback é recusado na conexão
+    monkeypatch.setattr(main, "WEBHOOK_HOSTS_PERMITIDOS", frozenset())
+
+    async def cenario():
+        fila = main.FilaWebhooks(max_tentativas=5)
+        await fila.iniciar()
+        async with Receptor() as receptor:
+            fila.agendar(f"http://localhost:{receptor.porta}/callback", {"id_requisicao": "req-4"})
+            await aguardar(lambda: fila.falhas)
+            await fila.encerrar()
+
+        assert not receptor.recebidas
+        assert fila.falhas[0]["tentativas"] == 1
+        assert "endereço interno" in fila.falhas[0]["erro"]
+
+    asyncio.run(cenario())
+
+
+def test_conexao_no_endereco_verificado_mantem_host(monkeypatch):
+    # Loopback liberado só aqui para exercitar o caminho de destino público
+    monkeypatch.setattr(main, "WEBHOOK_HOSTS_PERMITIDOS", frozenset())
+    monkeypatch.setattr(main, "endereco_publico", lambda endereco: True)
+
+    async def cenario():
+        fila = main.FilaWebhooks()
+        await fila.iniciar()
+        async with Receptor() as receptor:
+            fila.agendar(f"http://localhost:{receptor.porta}/callback", {"id_requisicao": "req-5"})
+            await aguardar(lambda: receptor.recebidas)
+            await fila.encerrar()
+
+        assert receptor.recebidas[0][0]["host"] == f"localhost:{receptor.porta}"
+
+    asyncio.run(cenario())
+
+
+@pytest.mark.parametrize("url", [
+    "http://localhost/cb",
+    "http://127.0.0.1:8000/cb",
+    "http://10.0.0.5/cb",
+    "http://192.168.0.10/cb",
+    "http://169.254.169.254/latest/meta-data",
+    "http://[::1]/cb",
+    "http://[::ffff:127.0.0.1]/cb",
+    "ftp://exemplo.com/cb",
+])
+def test_callback_url_recusada(monkeypatch, url):
+    monkeypatch.setattr(main, "WEBHOOK_HOSTS_PERMITIDOS", frozenset())
+    with pytest.raises(ValidationError):
+        main.WebhookRequest(callback_url=url)
+
+
+def test_callback_url_publica_aceita(monkeypatch):
+    monkeypatch.setattr(main, "WEBHOOK_HOSTS_PERMITIDOS", frozenset())
+    assert main.WebhookRequest(callback_url="https://meu-sistema.com/cb").callback_url
+
+
+def test_lista_de_hosts_permitidos(monkeypatch):
+    monkeypatch.setattr(main, "WEBHOOK_HOSTS_PERMITIDOS", frozenset({"hooks.empresa.local"}))
+    assert main.WebhookRequest(callback_url="http://hooks.empresa.local/cb").callback_url
+    with pytest.raises(ValidationError):
+        main.WebhookRequest(callback_url="https://meu-sistema.com/cb")